@@ -1,6 +1,7 @@
 from tokit import Request
 from tokit.utils import on
 from tokit.compiler import init_complier
+from tokit.bundle import BundleMixin
 from tokit.translation import init_locale, TranslationMixin
 
 @on('init')
@@ -8,7 +9,7 @@ def init(app):
     init_complier(app)
     init_locale(app.config)
 
-class Home(TranslationMixin, Request):
+class Home(BundleMixin, TranslationMixin, Request):
 
     URL = '/'
 
@@ -24,7 +25,7 @@ class Home(TranslationMixin, Request):
         yield 'home/x-sample.tag'
 
 
-class About(TranslationMixin, Request):
+class About(BundleMixin, TranslationMixin, Request):
 
     URL = '/about', 'about'
 
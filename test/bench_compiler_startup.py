@@ -0,0 +1,48 @@
+"""
+Compare worker startup with compiler contexts loaded eagerly (as
+``init_complier`` used to do) against lazily, on first compile::
+
+    python test/bench_compiler_startup.py
+"""
+import time
+
+SAMPLES = {
+    'CoffeeHandler': ('x.coffee', 'x = 1'),
+    'StylusHandler': ('x.styl', 'a\n  color red'),
+    'RiotHandler': ('x.tag', '<x><p>x</p></x>'),
+    'BabelHandler': ('x.es', 'let x = () => 1'),
+}
+
+
+def bench():
+    from tokit import compiler
+
+    started = time.time()
+    handlers = [handler for _, handler in compiler.make_compilers()]
+    lazy = time.time() - started
+    if not handlers:
+        print('No compiler available (needs PyExecJS and a JS runtime, or libsass)')
+        return
+
+    started = time.time()
+    for handler in handlers:
+        getattr(handler, 'context', None)
+    eager = time.time() - started
+
+    print('Without compilers (lazy contexts): {:.3f}s'.format(lazy))
+    print('With compilers (contexts loaded): {:.3f}s'.format(lazy + eager))
+    for handler in handlers:
+        if handler.__name__ not in SAMPLES:
+            continue
+        path, source = SAMPLES[handler.__name__]
+        started = time.time()
+        try:
+            handler.transform(path, source, handler.compile_options(path))
+        except Exception as e:
+            print('  first {} compile failed: {}'.format(handler.__name__, e))
+            continue
+        print('  first {} compile: {:.3f}s'.format(handler.__name__, time.time() - started))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,83 @@
+"""
+Compare chained per-module translations against the flattened catalog
+of ``init_locale``, for startup and for lookups::
+
+    python test/bench_translation.py
+"""
+import os
+import time
+import timeit
+import tempfile
+from collections import ChainMap, defaultdict
+
+from tornado import locale
+
+LANGS = ['en_US', 'fr_FR', 'vi_VN']
+
+
+class Config:
+
+    def __init__(self, root_path, modules):
+        self.root_path = root_path
+        self.modules_loaded = modules
+
+
+def make_modules(root, modules, entries):
+    names = []
+    for m in range(modules):
+        name = 'module{}'.format(m)
+        lang_path = os.path.join(root, name, 'lang')
+        os.makedirs(lang_path)
+        for lang in LANGS:
+            with open(os.path.join(lang_path, lang + '.csv'), 'w') as f:
+                for e in range(entries):
+                    f.write('"key {}-{}","{} {}-{}"\n'.format(m, e, lang, m, e))
+        names.append(name)
+    return Config(root, names)
+
+
+def chained(config):
+    """ Translations as loaded before the catalog """
+    chain = defaultdict(lambda: defaultdict(ChainMap))
+    for module in config.modules_loaded:
+        lang_path = os.path.join(config.root_path, module, 'lang')
+        if os.path.exists(lang_path):
+            locale.load_translations(lang_path)
+            for lang, plurals in locale._translations.items():
+                for plural, translation in plurals.items():
+                    chain[lang][plural].maps.append(translation)
+    locale._translations = chain
+    locale._supported_locales = frozenset(list(chain.keys()) + [locale._default_locale])
+    locale.Locale._cache = {}
+
+
+def lookups(config, number):
+    keys = ['key {}-0'.format(m) for m in range(len(config.modules_loaded))]
+    user_locale = locale.get('fr_FR')
+    seconds = timeit.timeit(lambda: [user_locale.translate(k) for k in keys], number=number)
+    return seconds / number / len(keys) * 1e6
+
+
+def bench(modules=20, entries=500, number=2000):
+    from tokit.translation import init_locale
+
+    with tempfile.TemporaryDirectory() as root:
+        config = make_modules(root, modules, entries)
+        catalog = os.path.join(root, 'locale.catalog')
+
+        start = time.perf_counter()
+        chained(config)
+        print('{:18} {:8.1f} ms'.format('chained startup', (time.perf_counter() - start) * 1e3))
+        expected = locale.get('fr_FR').translate('key 3-7')
+        print('{:18} {:8.2f} us/lookup'.format('chained lookup', lookups(config, number)))
+
+        for label in ('catalog build', 'catalog load'):
+            start = time.perf_counter()
+            init_locale(config, catalog)
+            print('{:18} {:8.1f} ms'.format(label, (time.perf_counter() - start) * 1e3))
+        assert locale.get('fr_FR').translate('key 3-7') == expected
+        print('{:18} {:8.2f} us/lookup'.format('catalog lookup', lookups(config, number)))
+
+
+if __name__ == '__main__':
+    bench()
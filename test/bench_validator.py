@@ -0,0 +1,58 @@
+"""
+Compare building a Cerberus validator per request against
+``ValidatorMixin`` (cached validator and compiled fast path)::
+
+    python test/bench_validator.py
+"""
+import timeit
+
+from cerberus import Validator
+
+SCHEMA = {
+    'username': {'type': 'string', 'minlength': 3, 'maxlength': 32, 'required': True},
+    'email': {'type': 'string', 'regex': r'^[^@]+@[^@]+$', 'required': True},
+    'age': {'type': 'integer', 'min': 0, 'coerce': int},
+    'tags': {'type': 'list', 'schema': {'type': 'string'}},
+    'profile': {'type': 'dict', 'schema': {
+        'bio': {'type': 'string', 'nullable': True},
+        'site': {'type': 'string'},
+    }},
+}
+VALID = {'username': 'tokit', 'email': 'a@b.c', 'age': '30', 'tags': ['x', 'y'],
+         'profile': {'bio': None, 'site': 'http://x'}}
+INVALID = {'username': 'x', 'email': 'nope', 'age': -1, 'tags': [1]}
+
+
+def bench(number=2000):
+    from tokit.api import ValidatorMixin, ValidationError
+
+    class Handler(ValidatorMixin):
+        SCHEMA = globals()['SCHEMA']
+
+    Handler.compile_schema()
+    handler = Handler()
+
+    def per_request(data):
+        validator = Validator(SCHEMA)
+        if not validator.validate(data):
+            return validator.errors
+        return validator.document
+
+    def mixin(data):
+        handler.data = data
+        try:
+            return handler.validate()
+        except ValidationError as e:
+            return e.detail
+
+    for data in (VALID, INVALID):
+        assert per_request(data) == mixin(data)
+
+    for name, fn in (('per request', per_request), ('mixin', mixin)):
+        for label, data in (('valid', VALID), ('invalid', INVALID)):
+            seconds = timeit.timeit(lambda: fn(data), number=number)
+            print('{:12} {:8} {:8.1f} us/call'.format(name, label, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    bench()
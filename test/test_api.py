@@ -0,0 +1,100 @@
+import json
+
+import pytest
+from cerberus import Validator
+from tornado.web import HTTPError
+
+from tokit.api import ChunkedJsonParser, compile_schema
+
+DOC = [
+    1, -2.5e3, 'a"b\\', {'x': [1, {'y': ']}'}], 'k\\': None}, [], {},
+    True, None, 'é</', [[['deep']]], 12345678901234567890,
+]
+
+
+def parse_chunked(text, size, ndjson=False, max_depth=None):
+    parser = ChunkedJsonParser(ndjson, max_depth)
+    raw = text.encode()
+    items = []
+    for i in range(0, len(raw), size):
+        items += parser.feed(raw[i:i + size])
+    return items + parser.feed(b'', final=True)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 64, 4096])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_chunked_array_same_as_json_loads(size, indent):
+    assert parse_chunked(json.dumps(DOC, indent=indent), size) == DOC
+
+
+@pytest.mark.parametrize('size', [1, 3, 64])
+def test_chunked_ndjson(size):
+    text = '\n'.join(json.dumps(item) for item in DOC)
+    assert parse_chunked(text, size, ndjson=True) == DOC
+
+
+@pytest.mark.parametrize('text', [
+    '[1 2]', '[1,,2]', '[1,2,]', '[,1]', '[1', '[1,', '["a', '[tru]',
+    '[12abc]', '[1]x', '{"a":1}', '[{]',
+])
+@pytest.mark.parametrize('size', [1, 100])
+def test_chunked_rejects_invalid(text, size):
+    with pytest.raises(HTTPError) as error:
+        parse_chunked(text, size)
+    assert error.value.status_code == 400
+
+
+def test_chunked_max_depth():
+    text = '[' + '[' * 50 + ']' * 50 + ']'
+    with pytest.raises(HTTPError, match='too deep'):
+        parse_chunked(text, 7, max_depth=32)
+    assert parse_chunked(text, 7) == json.loads(text)
+
+
+SCHEMAS = [
+    {'a': {'type': 'integer', 'min': 0}},
+    {'a': {'type': 'string', 'default': 'x'}},
+    {'a': {'type': 'string', 'nullable': True, 'default': 'x'}},
+    {'a': {'type': 'integer', 'coerce': int, 'default': '5'}},
+    {'a': {'type': 'list', 'allowed': ['x', 'y']}},
+    {'a': {'type': 'string', 'allowed': ['x', 'y']}},
+    {'a': {'type': 'string', 'regex': 'a|b'}},
+    {'a': {'type': 'dict', 'schema': {'b': {'type': 'integer', 'required': True}}}},
+    {'a': {'type': 'list', 'schema': {'type': 'integer', 'coerce': int}}},
+    {'a': {'type': ['string', 'integer'], 'maxlength': 3}},
+    {'a': {'type': 'number', 'max': 5}},
+    {'a': {'type': 'boolean'}},
+    {'a': {'type': 'string', 'empty': False}},
+    {'a': {'required': True}},
+    {'a': {'type': 'float'}},
+    {'a': {'type': 'string', 'coerce': str.lower, 'allowed': ['x']}},
+    {'a': {'type': 'integer', 'nullable': True, 'coerce': int}},
+    {'a': {'type': 'dict', 'schema': {'b': {'type': 'integer', 'default': 1}}}},
+    {'a': {'type': 'list', 'schema': {'type': 'dict', 'schema': {'c': {'type': 'string'}}}}},
+]
+
+VALUES = [
+    None, 0, -1, 1, 5, 6, 3.5, True, False, '', 'x', 'X', 'y', 'abc', 'abcd',
+    'a', 'b\n', '5', [], ['x'], ['x', 'z'], [1, '2'], {}, {'b': 1}, {'b': '1'},
+    {'b': None}, [{'c': 'x'}], [{'d': 1}], b'x', (1, 2),
+]
+
+
+@pytest.mark.parametrize('schema', SCHEMAS, ids=repr)
+def test_compiled_schema_agrees_with_cerberus(schema):
+    fast_validate = compile_schema(schema)
+    assert fast_validate
+    accepted = 0
+    for document in [{}, {'a': 1, 'z': 2}] + [{'a': value} for value in VALUES]:
+        result = fast_validate(document)
+        if result is None:
+            continue
+        accepted += 1
+        validator = Validator(schema)
+        assert validator.validate(document), document
+        assert result == validator.document, document
+    assert accepted
+
+
+def test_compile_schema_skips_unsupported_rules():
+    assert compile_schema({'a': {'type': 'string', 'excludes': 'b'}}) is None
@@ -0,0 +1,88 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from tornado.gen import sleep
+from tornado.ioloop import IOLoop
+
+from tokit import Assets
+from tokit.bundle import Bundler, rebase_css_urls
+
+
+@pytest.fixture
+def static(tmp_path):
+    (tmp_path / 'home').mkdir()
+    (tmp_path / 'riot.js').write_text('var a = 1;\nfoo();\n')
+    (tmp_path / 'home' / 'a.js').write_text('function b() {\n  return 2;\n}\n')
+    (tmp_path / 'home' / 'a.css').write_text('.a { background: url(img/x.png) }\n')
+    return tmp_path
+
+
+def read(static, path):
+    with open(os.path.join(str(static), path)) as f:
+        return f.read()
+
+
+def test_bundle_with_source_map(static, monkeypatch):
+    monkeypatch.setattr('tokit.bundle.minify', lambda kind, text: text)
+    bundler = Bundler(str(static))
+    built = bundler.bundle('js', ['riot.js', 'home/a.js'], 'home')
+
+    assert built.startswith('bundle/home.') and built in Assets.compiled_paths
+    filename = os.path.basename(built)
+    assert read(static, built) == (
+        'var a = 1;\nfoo();;\nfunction b() {\n  return 2;\n};\n' +
+        '//# sourceMappingURL={}.map\n'.format(filename))
+
+    source_map = json.loads(read(static, built + '.map'))
+    assert source_map['file'] == filename
+    assert [s['offset']['line'] for s in source_map['sections']] == [0, 2]
+    first, second = [s['map'] for s in source_map['sections']]
+    assert first['sources'] == ['/static/riot.js']
+    assert first['sourcesContent'] == ['var a = 1;\nfoo();\n']
+    assert second['mappings'] == 'AAAA;AACA;AACA'
+
+    # same parts are not built again, even by another process
+    assert Bundler(str(static)).bundle('js', ['riot.js', 'home/a.js'], 'home') == built
+
+
+def test_minified_part_maps_to_start_of_source(static, monkeypatch):
+    monkeypatch.setattr('tokit.bundle.minify', lambda kind, text: text.replace('\n  ', ' '))
+    built = Bundler(str(static)).bundle('js', ['home/a.js'], 'home')
+    section = json.loads(read(static, built + '.map'))['sections'][0]
+    assert section['map']['mappings'] == 'AAAA;AAAA'
+
+
+def test_css_urls_rebased(static):
+    built = Bundler(str(static)).bundle('css', ['home/a.css'], 'home')
+    assert 'url(../home/img/x.png)' in read(static, built)
+
+
+def test_rebase_css_urls():
+    css = ('a { b: url("img/x.png?v=1") url(../y.png) url(/abs.png) url(data:image/png;base64,x) '
+           'url(https://cdn/z.png) url(#filter) }')
+    assert rebase_css_urls(css, 'home/a.css', 'bundle') == (
+        'a { b: url("../home/img/x.png?v=1") url(../y.png) url(/abs.png) url(data:image/png;base64,x) '
+        'url(https://cdn/z.png) url(#filter) }')
+
+
+def test_get_builds_in_executor_and_limits_checks(static):
+    bundler = Bundler(str(static), check=True, check_interval=60)
+    calls = []
+    bundle = bundler.bundle
+    bundler.bundle = lambda *args: calls.append(args) or bundle(*args)
+    executor = ThreadPoolExecutor(1)
+
+    async def render():
+        paths = ['riot.js', 'home/a.js']
+        assert bundler.get('js', paths, 'home', executor) is None
+        assert bundler.get('js', paths, 'home', executor) is None
+        while bundler.pending:
+            await sleep(0.01)
+        built = bundler.get('js', paths, 'home', executor)
+        assert built and bundler.get('js', paths, 'home', executor) == built
+
+    IOLoop.current().run_sync(render)
+    executor.shutdown()
+    assert len(calls) == 1
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('momoko')
+
+from tokit.postgres import ResultCache, _prepare_sql, _estimate_size  # noqa: E402
+
+
+def test_result_cache_invalidates_by_table():
+    cache = ResultCache(1024 * 1024)
+    cache.set('posts', [{'id': 1}], 60, {'posts'})
+    cache.set('join', [{'id': 1}], 60, {'posts', 'users'})
+    cache.set('users', [{'id': 2}], 60, {'users'})
+    assert cache.get('posts') == [{'id': 1}]
+
+    before = time.time() - 1
+    cache.invalidate('posts')
+    assert cache.get('posts') is None
+    assert cache.get('join') is None
+    assert cache.get('users') == [{'id': 2}]
+    assert cache.invalidated_since(['posts'], before)
+    assert not cache.invalidated_since(['users'], before)
+    assert cache.info()['entries'] == 1
+
+
+def test_result_cache_expires_and_evicts():
+    rows = [{'id': i, 'text': 'x' * 100} for i in range(10)]
+    cache = ResultCache(_estimate_size(rows) * 3 // 2)
+    cache.set('a', rows, 60, {'t'})
+    cache.set('b', rows, 60, {'t'})
+    # a was least recently used
+    assert cache.get('a') is None
+    assert cache.get('b') == rows
+    assert cache.size <= cache.max_bytes
+
+    cache.set('b', rows, -1, {'t'})
+    assert cache.get('b') is None
+    assert cache.size == 0 and not cache.tags
+
+
+def test_result_cache_clear_invalidates_all():
+    cache = ResultCache(1024 * 1024)
+    cache.set('a', [], 60, {'t'})
+    before = time.time() - 1
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.invalidated_since(['other'], before)
+
+
+def test_prepare_sql():
+    name, sql, count = _prepare_sql('SELECT *\n  FROM posts WHERE id = %s AND n %% 2 = %s;')
+    assert name.startswith('tokit_')
+    assert sql == 'PREPARE {} AS SELECT * FROM posts WHERE id = $1 AND n % 2 = $2'.format(name)
+    assert count == 2
+    # only whitespace differs: same statement
+    assert _prepare_sql('SELECT * FROM t WHERE a = %s')[0] == _prepare_sql(' SELECT *\n FROM t\n WHERE a = %s ')[0]
+
+
+@pytest.mark.parametrize('query', [
+    'SELECT 1; SELECT 2',
+    'SELECT * FROM t WHERE a = %(a)s',
+    'SELECT * FROM t WHERE id IN %s',
+    'CREATE TABLE t (id int)',
+    'BEGIN',
+])
+def test_prepare_sql_skips_unpreparable(query):
+    assert _prepare_sql(query) is None
@@ -0,0 +1,76 @@
+import smtplib
+import threading
+import configparser
+import socketserver
+from email.mime.text import MIMEText
+
+from tokit.tasks import SmtpPool
+
+
+class SmtpSink(socketserver.StreamRequestHandler):
+    """ Minimal SMTP server keeping messages, refusing recipients starting with bad """
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 sink')
+            elif command == 'RCPT':
+                if line.split(':', 1)[1].strip(' <>').startswith('bad'):
+                    self.reply('550 no such user')
+                else:
+                    recipients.append(line)
+                    self.reply('250 ok')
+            elif command == 'DATA':
+                self.reply('354 go on')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                self.server.received += len(recipients)
+                self.reply('250 queued')
+            else:
+                if command in ('RSET', 'MAIL'):
+                    recipients = []
+                self.reply('250 ok')
+
+
+def make_pool(port):
+    config = configparser.ConfigParser()
+    config.read_dict({'smtp': {'host': '127.0.0.1', 'port': str(port), 'batch_size': '2'}})
+    return SmtpPool(config['smtp'])
+
+
+def make_message(receipt):
+    msg = MIMEText('body')
+    msg['Subject'] = 'subject'
+    msg['From'] = 'tokit@localhost'
+    msg['To'] = receipt
+    return msg
+
+
+def test_send_batch_keeps_going_after_refused_recipient():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpSink)
+    server.daemon_threads = True
+    server.received = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pool = make_pool(server.server_address[1])
+    try:
+        results = pool._send_batch([make_message(r) for r in ('a@x', 'bad@x', 'b@x')])
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+        assert server.received == 2
+        # the connection is still usable
+        assert pool._send_batch([make_message('c@x')]) == [None]
+        assert server.received == 3
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()
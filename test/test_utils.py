@@ -0,0 +1,61 @@
+import enum
+import json
+import dataclasses
+from uuid import UUID
+from decimal import Decimal
+from datetime import datetime, date
+
+import pytest
+
+from tokit.utils import JSON_BACKENDS, set_json_backend, to_json, to_json_chunks
+
+
+class Color(enum.Enum):
+    RED = 'red'
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+VALUES = [
+    '</script>',
+    ['</a', {'</b': 1}],
+    {'id': UUID(int=1), 'at': datetime(2017, 1, 2, 3, 4, 5), 'day': date(2017, 1, 2)},
+    {1: 'int key', None: 'none key', True: 'bool key'},
+    [float('nan'), float('inf'), -float('inf'), 0.5],
+    {'price': Decimal('1.10'), 'color': Color.RED, 'point': Point(1, 2)},
+    [2 ** 70, -2 ** 70, 'é', ' ', {'nested': [[], {}]}],
+    {'tuple': (1, 2), 'set': {3}, 'bytes': b'x'},
+]
+
+
+@pytest.fixture(params=sorted(JSON_BACKENDS))
+def backend(request):
+    set_json_backend(request.param)
+    yield request.param
+    set_json_backend('orjson' if 'orjson' in JSON_BACKENDS else 'json')
+
+
+@pytest.mark.parametrize('value', VALUES, ids=repr)
+def test_backends_agree(backend, value):
+    set_json_backend('json')
+    expected = to_json(value)
+    set_json_backend(backend)
+    assert to_json(value) == expected
+    assert '</' not in expected
+
+
+def test_chunks_join_to_same(backend):
+    value = [{'n': i, 'tag': '</b>'} for i in range(1000)]
+    assert ''.join(to_json_chunks(value, chunk_size=100)) == to_json(value)
+    assert json.loads(to_json(value)) == value
+
+
+def test_circular_reference_is_an_error(backend):
+    value = []
+    value.append(value)
+    with pytest.raises(ValueError):
+        to_json(value)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os, sys, re, collections, logging
-import time, signal, importlib, inspect, configparser, hashlib
+import time, signal, importlib, inspect, configparser, hashlib, json, threading
+import gzip, mimetypes
 from contextlib import contextmanager
 
 import tornado.locale
@@ -8,6 +9,10 @@ import tornado.web
 import tornado.websocket
 import tornado.netutil
 from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.concurrent import Future
+from tornado.http1connection import HTTP1Connection
+from tornado.gen import coroutine
 from tornado.autoreload import add_reload_hook
 from tornado import testing
 from tornado.httpserver import HTTPServer
@@ -127,6 +132,14 @@ class Request(HTMLErrorMixin, tornado.web.RequestHandler, metaclass=Registry):
         """ List (to preserved ordering) of CSS path to to used by layout file """
         return []
 
+    def js_urls(self):
+        """ URLs of ``js()`` for layout, ``BundleMixin`` makes it a single one """
+        return [self.static_url(path) for path in self.js()]
+
+    def css_urls(self):
+        """ URLs of ``css()`` for layout, ``BundleMixin`` makes it a single one """
+        return [self.static_url(path) for path in self.css()]
+
     def get_request_dict(self, *args):
         """
         Return dict of request arguments, use with standard HTTP form
@@ -207,15 +220,281 @@ class ValidPathMixin:
         return absolute_path
 
 
+class AssetManifest:
+    """
+    Persistent map of static files: relative path -> [hash, size, mtime]
+
+    Built once at startup (or at deploy time) and saved as JSON, afterward
+    a version lookup is a dict access. With ``check``, a file is stat-ed and
+    only re-hashed when its size or mtime changed.
+
+    Deploy-time usage::
+
+        AssetManifest(static_path, 'static.json', Assets.get_content_version).build().save()
+    """
+
+    def __init__(self, static_path, file=None, hasher=None):
+        self.static_path = static_path
+        self.file = file
+        self.hasher = hasher
+        self.files = {}
+        self.dirs = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.file and os.path.exists(self.file):
+            try:
+                with open(self.file) as f:
+                    self.files = json.load(f).get('files', {})
+            except ValueError:
+                logger.warning('Ignore broken asset manifest %s', self.file)
+        return self
+
+    def save(self):
+        if not (self.file and self.dirty):
+            return
+        with self._lock:
+            tmp_file = '{}.{}.tmp'.format(self.file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump({'files': self.files}, f, sort_keys=True)
+            os.replace(tmp_file, self.file)
+            self.dirty = False
+
+    def build(self):
+        """ Walk static path, hash new or changed files and drop deleted ones """
+        seen = set()
+        for base_path, _, files in os.walk(self.static_path):
+            for f in files:
+                abs_path = os.path.join(base_path, f)
+                if self.file_version(abs_path):
+                    seen.add(self._key(abs_path))
+        with self._lock:
+            for key in set(self.files) - seen:
+                del self.files[key]
+                self.dirty = True
+            self.dirs.clear()
+        return self
+
+    def _key(self, abs_path):
+        return os.path.relpath(abs_path, self.static_path)
+
+    def file_version(self, abs_path, check=True):
+        key = self._key(abs_path)
+        entry = self.files.get(key)
+        if entry and not check:
+            return entry[0]
+        try:
+            stat = os.stat(abs_path)
+        except OSError:
+            return None
+        if entry and entry[1] == stat.st_size and entry[2] == stat.st_mtime:
+            return entry[0]
+        try:
+            version = self.hasher(abs_path)
+        except Exception:
+            logger.error('Could not open static file %r', abs_path)
+            return None
+        with self._lock:
+            self.files[key] = [version, stat.st_size, stat.st_mtime]
+            self.dirs.clear()
+            self.dirty = True
+        return version
+
+    def dir_version(self, abs_path, check=True):
+        key = self._key(abs_path)
+        if not check and key in self.dirs:
+            return self.dirs[key]
+        hashes = []
+        for base_path, _, files in os.walk(abs_path):
+            hashes += [self.file_version(os.path.join(base_path, f), check) for f in sorted(files)]
+        version = "{}-{}".format(len(hashes), '-'.join(h for h in hashes if h))
+        self.dirs[key] = version
+        return version
+
+
+def _wait_writable(fd):
+    """ Resolve once ``fd`` can be written, without touching the IOStream owning it """
+    future = Future()
+    ioloop = IOLoop.current()
+
+    def _ready(fd, events):
+        ioloop.remove_handler(fd)
+        future.set_result(events)
+
+    ioloop.add_handler(fd, _ready, IOLoop.WRITE)
+    return future
+
+
 class Assets(ValidPathMixin, tornado.web.StaticFileHandler):
 
+    manifest = None
+    """ ``AssetManifest`` shared by all requests, see ``setup_assets`` """
+
+    manifest_check = True
+    """ stat files before trusting the manifest, off with ``static_hash_cache`` """
+
+    ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+    """ Precompressed siblings, by preference, see ``precompress_assets`` """
+
+    SENDFILE_MIN_SIZE = 64 * 1024
+    """ Files from this size are written with ``os.sendfile`` """
+
+    SENDFILE_CHUNK = 1024 * 1024
+
+    IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+    compiled = {}
+    """ Source path -> its ahead-of-time build, see ``load_compiled`` """
+
+    compiled_paths = frozenset()
+
+    original_path = None
+    content_encoding = None
+    zero_copy = None
+
     def set_default_headers(self):
-        self.set_header('Cache-Control', "max-age: 2592000'")
+        self.set_header('Cache-Control', "public, max-age=2592000")
+
+    @classmethod
+    def load_compiled(cls, manifest_file, static_path):
+        """ Read the manifest written by ``python -m tokit.compiler --mode=build`` """
+        with open(manifest_file) as f:
+            assets = json.load(f)['assets']
+        dest = os.path.dirname(os.path.abspath(manifest_file))
+        cls.compiled = {
+            source: os.path.relpath(os.path.join(dest, built), static_path)
+            for source, built in assets.items()
+        }
+        cls.compiled_paths = frozenset(cls.compiled.values())
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        built = cls.compiled.get(path)
+        if built:
+            # named by content hash already
+            return settings.get('static_url_prefix', '/static/') + built
+        return super().make_static_url(settings, path, include_version)
+
+    def set_headers(self):
+        super().set_headers()
+        if 'v' in self.request.arguments or self.path in self.compiled_paths:
+            # hashed url: content never changes under it
+            self.set_header('Cache-Control', 'public, max-age={}, immutable'.format(self.IMMUTABLE_MAX_AGE))
+
+    def accepted_encodings(self):
+        accepted = set()
+        for part in self.request.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = part.partition(';')
+            params = params.replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    if float(params[2:]) == 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(name.strip().lower())
+        return accepted
+
+    def validate_absolute_path(self, root, absolute_path):
+        """ Swap in a precompressed sibling when the client accepts it and it is up to date """
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        self.original_path = absolute_path
+        accepted = self.accepted_encodings()
+        compressible = False
+        for encoding, suffix in self.ENCODINGS:
+            try:
+                stat = os.stat(absolute_path + suffix)
+            except OSError:
+                continue
+            compressible = True
+            if encoding in accepted and stat.st_mtime >= os.stat(absolute_path).st_mtime:
+                self.content_encoding = encoding
+                self.set_header('Content-Encoding', encoding)
+                absolute_path += suffix
+                break
+        if compressible and not self.settings.get('compress_response'):
+            # GZipContentEncoding adds it by itself
+            self.set_header('Vary', 'Accept-Encoding')
+        return absolute_path
+
+    def get_content_type(self):
+        if not self.content_encoding:
+            return super().get_content_type()
+        mime_type, _ = mimetypes.guess_type(self.original_path)
+        return mime_type or 'application/octet-stream'
+
+    def can_sendfile(self, size):
+        if size < self.SENDFILE_MIN_SIZE or not hasattr(os, 'sendfile'):
+            return False
+        connection = self.request.connection
+        if not isinstance(connection, HTTP1Connection) or type(connection.stream) is not IOStream:
+            # TLS and in-process connections need the bytes in Python
+            return False
+        content_type = self._headers.get('Content-Type', '').split(';')[0]
+        gzipping = (
+            self.settings.get('compress_response') and
+            not self.content_encoding and
+            (content_type.startswith('text/') or content_type in tornado.web.GZipContentEncoding.CONTENT_TYPES)
+        )
+        return not gzipping
+
+    def get_content(self, abs_path, start=None, end=None):
+        """
+        Large files are left to ``sendfile``, others are read as usual.
+        Unlike ``StaticFileHandler`` this is called on the instance only
+        """
+        size = (end or self.get_content_size()) - (start or 0)
+        if self.can_sendfile(size):
+            self.zero_copy = (start or 0, size)
+            return []
+        return super().get_content(abs_path, start, end)
+
+    @coroutine
+    def get(self, path, include_body=True):
+        yield super().get(path, include_body)
+        if self.zero_copy:
+            try:
+                yield self.sendfile(*self.zero_copy)
+            except StreamClosedError:
+                return
+
+    @coroutine
+    def sendfile(self, offset, count):
+        """ Zero-copy body: headers go through the IOStream, then the file straight to the socket """
+        connection = self.request.connection
+        stream = connection.stream
+        yield self.flush()
+        sock_fd = os.dup(stream.socket.fileno())
+        sent = 0
+        try:
+            with open(self.absolute_path, 'rb') as f:
+                while sent < count:
+                    try:
+                        n = os.sendfile(sock_fd, f.fileno(), offset + sent, min(count - sent, self.SENDFILE_CHUNK))
+                    except BlockingIOError:
+                        yield _wait_writable(sock_fd)
+                        continue
+                    if not n:
+                        break
+                    sent += n
+        except OSError as e:
+            logger.debug('sendfile %s: %s', self.absolute_path, e)
+        finally:
+            os.close(sock_fd)
+        if sent < count:
+            # client gone or file truncated, the response can't be completed
+            stream.close()
+            raise StreamClosedError()
+        # bytes bypassed HTTP1Connection.write, keep its Content-Length accounting right
+        connection._expected_content_remaining -= sent
 
     @classmethod
     def get_version(cls, settings, path):
         abs_path = cls.get_absolute_path(settings['static_path'], path)
         if os.path.isdir(abs_path):
+            if cls.manifest:
+                return cls.manifest.dir_version(abs_path, cls.manifest_check)
             hashes = []
             for base_path, _, files in os.walk(abs_path):
                 hashes += [cls._get_cached_version(os.path.join(base_path, f)) for f in files]
@@ -224,21 +503,112 @@ class Assets(ValidPathMixin, tornado.web.StaticFileHandler):
             return cls._get_cached_version(abs_path)
 
     @classmethod
-    def get_content_version(cls, abs_path):
-        data = cls.get_content(abs_path)
+    def _get_cached_version(cls, abs_path):
+        if cls.manifest:
+            return cls.manifest.file_version(abs_path, cls.manifest_check)
+        return super()._get_cached_version(abs_path)
 
-        # use sha-256
+    @classmethod
+    def get_content_version(cls, abs_path):
+        # use sha-256, reading in chunks
         hasher = hashlib.sha256()
-        if isinstance(data, bytes):
-            hasher.update(data)
-        else:
-            for chunk in data:
+        with open(abs_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
                 hasher.update(chunk)
         return hasher.hexdigest()[0:6]
 
+
+PRECOMPRESS_TYPES = ('.js', '.css', '.html', '.svg', '.json', '.map', '.txt', '.tag', '.ico')
+
+
+def precompress_assets(static_path, min_size=1024, types=PRECOMPRESS_TYPES):
+    """
+    Write ``.gz`` (and ``.br`` when ``brotli`` is installed) siblings of
+    compressible static files, for ``Assets`` to serve by ``Accept-Encoding``.
+    Up-to-date siblings are skipped, useless ones removed.
+
+    :return: number of written files
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        logger.info('brotli is not installed, only .gz files are built')
+
+    compressors = [('.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli:
+        compressors.insert(0, ('.br', lambda data: brotli.compress(data, quality=11)))
+
+    written = 0
+    for base_path, _, files in os.walk(static_path):
+        for f in files:
+            if not f.endswith(types):
+                continue
+            abs_path = os.path.join(base_path, f)
+            stat = os.stat(abs_path)
+            if stat.st_size < min_size:
+                continue
+            data = None
+            for suffix, compress in compressors:
+                target = abs_path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= stat.st_mtime:
+                    continue
+                if data is None:
+                    with open(abs_path, 'rb') as fp:
+                        data = fp.read()
+                compressed = compress(data)
+                if len(compressed) >= len(data) * 0.95:
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                with open(target + '.tmp', 'wb') as fp:
+                    fp.write(compressed)
+                os.replace(target + '.tmp', target)
+                written += 1
+    return written
+
+
+@on('init')
+def setup_assets(app):
+    """
+    Build the static manifest once per process
+
+    Sample env.ini::
+
+        [app]
+        # relative to project root, empty to keep it in memory only
+        static_manifest=../build/static.json
+        # from python3 -m tokit.compiler --mode=build, static_url() then
+        # points .coffee, .styl... to their built files
+        compiled_manifest=build/compiled.json
+    """
+    config = app.config
+    manifest_file = config.env['app'].get('static_manifest', '')
+    if manifest_file:
+        manifest_file = os.path.join(config.root_path, manifest_file)
+        os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    static_path = app.settings['static_path']
+    started = time.time()
+    Assets.manifest = AssetManifest(static_path, manifest_file, Assets.get_content_version).load().build()
+    Assets.manifest_check = not app.settings.get('static_hash_cache', True)
+    Assets.manifest.save()
+
+    compiled_manifest = config.env['app'].get('compiled_manifest', '')
+    if compiled_manifest:
+        compiled_manifest = os.path.join(config.root_path, compiled_manifest)
+        if os.path.exists(compiled_manifest):
+            Assets.load_compiled(compiled_manifest, static_path)
+        else:
+            logger.warning('Missing compiled assets manifest %s', compiled_manifest)
+    logger.debug('Asset manifest: %d files in %.3fs', len(Assets.manifest.files), time.time() - started)
+
+
 class Config:
     """ Subclass this to customize runtime config """
 
+    worker_id = 0
+    """ Id of pre-forked worker process, see ``fork_workers`` """
+
     settings = dict(
         static_path='.',
         static_url_prefix='/static/',
@@ -349,9 +719,34 @@ def setup_logging(config):
         logger.addHandler(fh)
 
 
+class _HandlerDelegate(tornado.web._HandlerDelegate):
+    """
+    A handler with a ``request_body_limit(app, headers)`` classmethod refuses
+    bigger bodies before receiving them, not after buffering them whole.
+    No limit returned keeps tornado's ``max_body_size``
+    """
+
+    def headers_received(self, start_line, headers):
+        limit_of = getattr(self.handler_class, 'request_body_limit', None)
+        limit = limit_of(self.application, headers) if limit_of else None
+        if limit:
+            self.request.connection.set_max_body_size(limit)
+            length = headers.get('Content-Length', '')
+            if length.isdigit() and int(length) > limit:
+                # answered before reading body, the connection is then closed
+                self.handler_class = tornado.web.ErrorHandler
+                self.handler_kwargs = {'status_code': 413}
+                self.stream_request_body = True
+        return super().headers_received(start_line, headers)
+
+
 class App(tornado.web.Application):
     config = None
 
+    def get_handler_delegate(self, request, target_class, target_kwargs=None,
+                             path_args=None, path_kwargs=None):
+        return _HandlerDelegate(self, request, target_class, target_kwargs, path_args, path_kwargs)
+
     @classmethod
     def instance(cls, config):
         config.load_modules()
@@ -388,23 +783,159 @@ def install_asyncio():
     AsyncIOMainLoop().install()
     logger.debug('Enabled asyncio')
 
+def _reset_ioloop():
+    """ A forked worker must not share parent's IOLoop (and its epoll fd) """
+    if not IOLoop.initialized():
+        return
+    asyncio_loop = getattr(IOLoop.instance(), 'asyncio_loop', None)
+    IOLoop.clear_current()
+    IOLoop.clear_instance()
+    if asyncio_loop:
+        import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        install_asyncio()
+
+
+def fork_workers(config, num_workers):
+    """
+    Pre-fork ``num_workers`` processes, the parent stays as a supervisor:
+    it respawns crashed workers and forwards SIGTERM / SIGINT to them.
+    Only children return from this function.
+
+    Sample env.ini::
+
+        [app]
+        workers=4
+        # 0 means one worker per CPU
+        reuse_port=False
+        # each worker binds its own socket with SO_REUSEPORT
+        pin_cpu=False
+        # bind worker N to Nth CPU this process may run on
+        max_restarts=100
+        # within restart_window seconds
+        restart_window=3600
+
+    :return: int worker id (0 based)
+    """
+    env = config.env['app']
+    num_cpu = os.cpu_count() or 1
+    if num_workers <= 0:
+        num_workers = num_cpu
+    pin_cpu = env.getboolean('pin_cpu', False) and hasattr(os, 'sched_setaffinity')
+    # cpuset or container limits may not allow all CPUs
+    cpus = sorted(os.sched_getaffinity(0)) if pin_cpu else []
+    max_restarts = env.getint('max_restarts', 100)
+    restart_window = env.getfloat('restart_window', 3600)
+
+    children = {}
+    stopping = False
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if pin_cpu:
+                os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+            return True
+        children[pid] = worker_id
+        return False
+
+    for worker_id in range(num_workers):
+        if spawn(worker_id):
+            return worker_id
+
+    def _on_term(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _on_term)
+    signal.signal(signal.SIGINT, _on_term)
+    logger.info('Supervisor PID {pid} started {num} workers'.format(
+        pid=os.getpid(), num=num_workers))
+
+    restarts = collections.deque()
+    exit_code = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid not in children:
+            continue
+        worker_id = children.pop(pid)
+        if stopping:
+            continue
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            logger.info('Worker %d (PID %d) exited', worker_id, pid)
+            continue
+        if os.WIFSIGNALED(status):
+            logger.warning('Worker %d (PID %d) killed by signal %d',
+                           worker_id, pid, os.WTERMSIG(status))
+        else:
+            logger.warning('Worker %d (PID %d) exited with status %d',
+                           worker_id, pid, os.WEXITSTATUS(status))
+        now = time.monotonic()
+        restarts.append(now)
+        while restarts[0] < now - restart_window:
+            restarts.popleft()
+        if len(restarts) > max_restarts:
+            logger.error('Too many worker restarts, giving up')
+            # so a process manager restarts it on failure
+            exit_code = 1
+            _on_term(None, None)
+            continue
+        if spawn(worker_id):
+            return worker_id
+
+    logger.info('Supervisor stopped')
+    sys.exit(exit_code)
+
+
 def start(host, port, config):
     """
     Entry point for application.
     This setups IOLoop, load classes and run HTTP server
-    """
 
+    With ``workers`` config other than 1, the listening socket is bound
+    before forking and each worker builds its own app, so ``init`` hooks
+    (database pools, executors...) run again after the fork.
+    """
+    env = config.env['app']
+    workers = env.getint('workers', 1)
+    reuse_port = env.getboolean('reuse_port', False)
+    sockets = None
+
+    if workers != 1:
+        if not reuse_port:
+            # shared accept socket, inherited by all workers
+            sockets = tornado.netutil.bind_sockets(port, host)
+        config.worker_id = fork_workers(config, workers)
+        _reset_ioloop()
+
+    if not sockets:
+        sockets = tornado.netutil.bind_sockets(port, host, reuse_port=reuse_port)
+
+    started = time.time()
     app = App.instance(config)
     ioloop = IOLoop.instance()
     http_server = HTTPServer(app, xheaders=True)
-
-
-    http_server.listen(port, host)
-    logger.info('Running PID {pid} @ http://{host}:{port}'.format(host=host, pid=os.getpid(), port=port))
+    http_server.add_sockets(sockets)
+    logger.info('Running PID {pid} @ http://{host}:{port}, ready in {sec:.3f}s'.format(
+        host=host, pid=os.getpid(), port=port, sec=time.time() - started))
 
     def _reload():
         """ reload Python code should also clear cache """
         Assets.reset()
+        if Assets.manifest:
+            Assets.manifest.save()
         with Request._template_loader_lock:
             for loader in Request._template_loaders.values():
                 loader.reset()
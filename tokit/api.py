@@ -1,6 +1,10 @@
 import re
 import json
+import codecs
+import threading
+import email.utils
 import traceback
+from collections.abc import Mapping, Sequence, Sized, Iterable
 import functools
 import string
 import random
@@ -11,34 +15,125 @@ import logging
 from tornado.websocket import WebSocketHandler
 from tornado.gen import coroutine
 from tornado.web import HTTPError
+from tornado.concurrent import Future
+from tornado.httputil import url_concat, HTTPHeaders, HTTPServerRequest
 
+import shortuuid
 from cerberus import Validator
 
 from tokit import Registry, Request, logger, on
-from tokit.utils import to_json
+from tokit.utils import to_json, json_too_deep, md5
+from tokit.utils import parse_json as _parse_json
 
 SHORT_UUID_RE = '[\-a-zA-Z0-9]{22}'
 
-def parse_json(s):
+_NOT_PARSED = object()
+
+def parse_json(s, max_depth=None):
+    """
+    :param s: str or bytes
+    :raise HTTPError: 400 if invalid or nested deeper than ``max_depth``
+    """
     try:
-        return json.loads(s)
+        data = _parse_json(s)
     except ValueError as e:
-        raise HTTPError(500, 'Invalid JSON: ' + str(e))
+        raise HTTPError(400, 'Invalid JSON: ' + str(e))
+    except RecursionError:
+        raise HTTPError(400, 'JSON nested too deep')
+    # only walk the structure if it may be too deep
+    if max_depth and s.count(b'[' if isinstance(s, bytes) else '[') + \
+            s.count(b'{' if isinstance(s, bytes) else '{') > max_depth:
+        if json_too_deep(data, max_depth):
+            raise HTTPError(400, 'JSON nested too deep')
+    return data
 
 
 class JsonMixin:
     """
-    * Auto parse JSON request body and store in self.data
+    * Parse JSON request body on first access to self.data
     * Support render whatever objects as JSON
+
+    Limits can be set per class or in env.ini, a bigger JSON body
+    (or one without Content-Type) is refused with 413 before being received.
+    Other bodies, like uploads, keep tornado's ``max_body_size``::
+
+        [app]
+        max_json_body=1048576
+        max_json_depth=32
     """
 
-    def prepare(self):
-        self.data = None
-        if self.request.body:
-            try:
-                self.data = parse_json(self.request.body.decode())
-            except ValueError as e:
-                self.write_exception(e)
+    MAX_BODY_SIZE = None
+    MAX_DEPTH = None
+
+    _data = _NOT_PARSED
+
+    @classmethod
+    def request_body_limit(cls, app, headers=None):
+        content_type = headers.get('Content-Type', '') if headers else ''
+        if content_type and 'json' not in content_type:
+            return None
+        return cls.MAX_BODY_SIZE or app.config.env['app'].getint('max_json_body', 1024 * 1024)
+
+    @property
+    def max_body_size(self):
+        return self.request_body_limit(self.application)
+
+    @property
+    def max_depth(self):
+        return self.MAX_DEPTH or self.env['app'].getint('max_json_depth', 32)
+
+    @property
+    def data(self):
+        if self._data is _NOT_PARSED:
+            self._data = self.parse_body()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def parse_body(self):
+        body = self.request.body
+        if not body:
+            return None
+        if len(body) > self.max_body_size:
+            raise HTTPError(413, 'Request body too large')
+        return parse_json(body, self.max_depth)
+
+    @coroutine
+    def write_json_stream(self, stream, key='items', ndjson=False):
+        """
+        Write batches of rows progressively and flush each batch,
+        so memory usage doesn't depend on the number of rows.
+
+        :param stream: has ``fetch()`` coroutine returning a list, empty when done
+            and ``close()`` coroutine
+        :param key: name of the array, result is ``{"items": [...]}``
+        :param ndjson: write one JSON object per line instead
+        """
+        if ndjson:
+            self.set_header("Content-Type", "application/x-ndjson; charset=UTF-8")
+        else:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write('{' + to_json(key) + ':[')
+        first = True
+        try:
+            while True:
+                rows = yield stream.fetch()
+                if not rows:
+                    break
+                if ndjson:
+                    self.write(''.join(to_json(row) + '\n' for row in rows))
+                else:
+                    chunk = ','.join(to_json(row) for row in rows)
+                    self.write(chunk if first else ',' + chunk)
+                first = False
+                yield self.flush()
+        finally:
+            # client may be gone, don't hold the database connection
+            yield stream.close(commit=False)
+        if not ndjson:
+            self.write(']}')
 
     def write_json(self, obj=None, **kwargs):
         if isinstance(obj, list):
@@ -48,6 +143,272 @@ class JsonMixin:
         self.write(to_json(ret))
 
 
+_SCALAR_END_RE = re.compile(r'[ \t\r\n,\]]')
+_STRING_SPECIAL_RE = re.compile(r'["\\]')
+_NESTED_SPECIAL_RE = re.compile(r'["\[\]{}]')
+
+
+class ChunkedJsonParser:
+    """
+    Incremental parser of a JSON array or NDJSON,
+    return each item as soon as it's complete.
+
+    An item split between chunks is kept in pieces, new chunks are only
+    scanned for its end, then it is parsed once.
+    """
+
+    def __init__(self, ndjson=False, max_depth=None):
+        self.ndjson = ndjson
+        self.max_depth = max_depth
+        self.pending = []
+        """ Pieces of an incomplete item (or NDJSON line) """
+        self.started = False
+        self.ended = False
+        self.expect = 'first'
+        """ In array: ``first`` item or end, ``item`` after a comma, ``separator`` after an item """
+        self.scalar = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.raw_decode = json.JSONDecoder().raw_decode
+
+    def _check(self, item):
+        if self.max_depth and json_too_deep(item, self.max_depth):
+            raise HTTPError(400, 'JSON nested too deep')
+        return item
+
+    def _parse_item(self, text):
+        try:
+            item, end = self.raw_decode(text)
+        except ValueError as e:
+            raise HTTPError(400, 'Invalid JSON: ' + str(e))
+        except RecursionError:
+            raise HTTPError(400, 'JSON nested too deep')
+        if end != len(text):
+            raise HTTPError(400, 'Invalid JSON: unexpected data after item')
+        return self._check(item)
+
+    def _start_item(self, char):
+        self.scalar = char not in '"[{'
+        self.in_string = char == '"'
+        self.depth = 1 if char in '[{' else 0
+        self.escaped = False
+
+    def _scan(self, text, pos):
+        """
+        Continue scanning the current item
+
+        :return end of item in text, None if it continues after text
+        """
+        if self.scalar:
+            match = _SCALAR_END_RE.search(text, pos)
+            return match.start() if match else None
+        if self.escaped:
+            self.escaped = False
+            pos += 1
+        while True:
+            if self.in_string:
+                match = _STRING_SPECIAL_RE.search(text, pos)
+                if not match:
+                    return None
+                pos = match.end()
+                if match.group() == '\\':
+                    if pos == len(text):
+                        self.escaped = True
+                        return None
+                    pos += 1
+                    continue
+                self.in_string = False
+                if not self.depth:
+                    return pos
+                continue
+            match = _NESTED_SPECIAL_RE.search(text, pos)
+            if not match:
+                return None
+            char, pos = match.group(), match.end()
+            if char == '"':
+                self.in_string = True
+            elif char in '[{':
+                self.depth += 1
+                if self.max_depth and self.depth > self.max_depth:
+                    raise HTTPError(400, 'JSON nested too deep')
+            else:
+                self.depth -= 1
+                if not self.depth:
+                    return pos
+
+    def feed(self, chunk, final=False):
+        """ :return list of completed items """
+        text = self.decoder.decode(chunk, final)
+        if self.ndjson:
+            lines = text.split('\n')
+            if len(lines) == 1 and not final:
+                self.pending.append(text)
+                return []
+            lines[0] = ''.join(self.pending) + lines[0]
+            self.pending = [] if final else [lines.pop()]
+            return [self._check(parse_json(line)) for line in lines if line.strip()]
+
+        items = []
+        pos = 0
+        if self.pending:
+            end = self._scan(text, 0)
+            if end is None:
+                if final and self.scalar:
+                    end = len(text)
+                else:
+                    self.pending.append(text)
+                    if final:
+                        raise HTTPError(400, 'Invalid JSON: unterminated item')
+                    return items
+            items.append(self._parse_item(''.join(self.pending) + text[:end]))
+            self.pending = []
+            self.expect = 'separator'
+            pos = end
+
+        while True:
+            while pos < len(text) and text[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(text):
+                break
+            char = text[pos]
+            if self.ended:
+                raise HTTPError(400, 'Invalid JSON: data after end of array')
+            if not self.started:
+                if char != '[':
+                    raise HTTPError(400, 'Invalid JSON: expect an array')
+                self.started = True
+                pos += 1
+                continue
+            if self.expect == 'separator':
+                if char not in ',]':
+                    raise HTTPError(400, 'Invalid JSON: expect , or ]')
+            elif char == ',' or (char == ']' and self.expect == 'item'):
+                raise HTTPError(400, 'Invalid JSON: unexpected ' + char)
+            if char == ']':
+                self.ended = True
+                pos += 1
+                continue
+            if char == ',':
+                self.expect = 'item'
+                pos += 1
+                continue
+
+            try:
+                item, end = self.raw_decode(text, pos)
+            except ValueError:
+                end = None
+            except RecursionError:
+                raise HTTPError(400, 'JSON nested too deep')
+            # a number may continue in next chunk
+            if end is not None and (end < len(text) or final or char in '"[{'):
+                items.append(self._check(item))
+                self.expect = 'separator'
+                pos = end
+                continue
+
+            # incomplete or invalid, scan to its end
+            self._start_item(char)
+            end = self._scan(text, pos + 1)
+            if end is None:
+                if final and self.scalar:
+                    end = len(text)
+                else:
+                    if final:
+                        raise HTTPError(400, 'Invalid JSON: unterminated item')
+                    self.pending = [text[pos:]]
+                    return items
+            items.append(self._parse_item(text[pos:end]))
+            self.expect = 'separator'
+            pos = end
+
+        if final and self.started and not self.ended:
+            raise HTTPError(400, 'Invalid JSON: unterminated array')
+        return items
+
+
+class JsonStreamMixin(JsonMixin):
+    """
+    Parse a big JSON array or NDJSON (``Content-Type: application/x-ndjson``)
+    body while receiving it, instead of buffering it whole.
+    Must be used with ``@tornado.web.stream_request_body``::
+
+        @stream_request_body
+        class Import(JsonStreamMixin, PlainApi):
+
+            def on_json_item(self, item):
+                pass  # by default, items are collected in self.data
+    """
+
+    MAX_BODY_SIZE = 100 * 1024 * 1024
+
+    _json_error = None
+
+    def prepare(self):
+        self.request.connection.set_max_body_size(self.max_body_size)
+        content_type = self.request.headers.get('Content-Type', '')
+        self._json_parser = ChunkedJsonParser(
+            ndjson='ndjson' in content_type,
+            max_depth=self.max_depth
+        )
+        self._items = []
+
+    def data_received(self, chunk):
+        if self._json_error:
+            return
+        try:
+            for item in self._json_parser.feed(chunk):
+                self.on_json_item(item)
+        except HTTPError as e:
+            # raised here it would close the connection, answer it once body is received
+            self._json_error = e
+
+    def on_json_item(self, item):
+        self._items.append(item)
+
+    def parse_body(self):
+        """ Called on first access of self.data, when body was received """
+        if self._json_error:
+            raise self._json_error
+        for item in self._json_parser.feed(b'', final=True):
+            self.on_json_item(item)
+        return self._items
+
+
+class ConditionalMixin:
+    """ Answer conditional GET before doing expensive work """
+
+    def not_modified(self, etag, last_modified=None):
+        """
+        Set ``Etag`` / ``Last-Modified`` headers and check ``If-None-Match``
+        or ``If-Modified-Since`` of request
+
+        :return True if response was finished with 304
+        """
+        self.set_header('Etag', etag)
+        if last_modified:
+            self.set_header('Last-Modified', last_modified)
+        if self.request.headers.get('If-None-Match'):
+            modified = not self.check_etag_header()
+        elif last_modified and self.request.headers.get('If-Modified-Since'):
+            try:
+                since = email.utils.parsedate_to_datetime(self.request.headers['If-Modified-Since'])
+                if last_modified.tzinfo is None:
+                    since = since.replace(tzinfo=None)
+                modified = last_modified.replace(microsecond=0) > since
+            except (TypeError, ValueError):
+                # malformed date
+                modified = True
+        else:
+            modified = True
+        if modified:
+            return False
+        self.set_status(304)
+        self.finish()
+        return True
+
+
 class ErrorMixin:
     """
     Show errors in JSON instead of default HTML
@@ -71,14 +432,18 @@ class ErrorMixin:
             self.finish()
 
 
-class Resource(ErrorMixin, JsonMixin, Request):
+class Resource(ConditionalMixin, ErrorMixin, JsonMixin, Request):
     """
     This provides quickway to build an API around a database object,
     supply ``list`` and ``create`` actions.
 
     This must be subclass and mixin with a database mixin
     which supports database operation such as:
-    ``db_query, db_insert`, `db_serialize``, and ``db_select``
+    ``db_query, db_insert`, `db_serialize``, and ``db_select``,
+    ``db_insert_many`` is needed to accept a JSON array in ``post``
+
+    Listing is paginated by ``db_page``, with ``?limit=`` and ``?cursor=``
+    arguments. The token of next page is in ``next`` and ``Link`` header.
 
     To check permissions, overide ``prepare`` method.
     """
@@ -87,34 +452,94 @@ class Resource(ErrorMixin, JsonMixin, Request):
     URL_PREFIX = '/api'
     TABLE = None
 
+    STREAM = None
+    """ Set to ``'json'`` or ``'ndjson'`` to stream listing, requires ``db_stream`` """
+
+    STREAM_BATCH_SIZE = 500
+
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+
+    ESTIMATE_COUNT = False
+    """ Add approximate ``total`` to listing, requires ``db_estimate_count`` """
+
+    CONDITIONAL = True
+    """ Answer 304 from table version, when ``db_table_version`` has one """
+
     @coroutine
     def get(self):  # list items
-        t, q = self.db_prepare(self.TABLE)
-        rows = yield self.db_select(q.fields('*'))
-        rows = self.db_serialize(rows)
-        self.write_json(length=len(rows), items=rows)
+        if self.STREAM:
+            stream = self.db_stream('SELECT * FROM ' + self.TABLE,
+                                    batch_size=self.STREAM_BATCH_SIZE)
+            yield self.write_json_stream(stream, ndjson=(self.STREAM == 'ndjson'))
+            return
+        try:
+            limit = int(self.get_query_argument('limit', self.PAGE_SIZE))
+        except ValueError:
+            raise HTTPError(400, 'Invalid limit')
+        limit = max(1, min(limit, self.MAX_PAGE_SIZE))
+        cursor = self.get_query_argument('cursor', None)
+
+        if self.CONDITIONAL and hasattr(self, 'db_table_version'):
+            version = yield self.db_table_version(self.TABLE)
+            if version:
+                etag = '"{}-{}-{}"'.format(self.TABLE, version[0], md5(self.request.query)[:8])
+                if self.not_modified(etag, version[1]):
+                    return
+
+        rows, next_cursor = yield self.db_page(self.TABLE, limit, cursor)
+        result = dict(length=len(rows), items=rows)
+        if next_cursor:
+            result['next'] = next_cursor
+            next_url = url_concat(self.request.path, dict(limit=limit, cursor=next_cursor))
+            self.set_header('Link', '<{}>; rel="next"'.format(next_url))
+        if self.ESTIMATE_COUNT:
+            result['total'] = yield self.db_estimate_count(self.TABLE)
+        self.write_json(result)
 
     @coroutine
     def post(self):
         self.set_status(201)
-        ret = yield self.db_insert(self.TABLE, self.data)
+        if isinstance(self.data, list):
+            # bulk create from a JSON array
+            ret = yield self.db_insert_many(self.TABLE, self.data)
+        else:
+            ret = yield self.db_insert(self.TABLE, self.data)
         self.write_json(ret=ret)
 
 
-class Item(ErrorMixin, JsonMixin, Request):
+class Item(ConditionalMixin, ErrorMixin, JsonMixin, Request):
     """
     This similar to `Resource` class, supply get an item out of list and
     PATCH/DELETE actions.
+
+    ``get`` answers 304 from the row version (Postgres ``xmin``)
+    before reading and encoding the row.
     """
     REPO = 'Item'
     URL_PREFIX = '/api'
     TABLE = None
 
+    LAST_MODIFIED_FIELD = None
+    """ Column of last modification time (such as ``updated_at``), for ``Last-Modified`` """
+
+    def decode_id(self, row_id):
+        """ URL contains short UUID """
+        return shortuuid.decode(row_id)
+
     @coroutine
     def get(self, row_id):
-        t, q = self.db_prepare(self.TABLE, row_id=row_id)
-        rows = yield self.db_select(q.fields('*'))
-        self.write_json(item=rows[0])
+        row_id = self.decode_id(row_id)
+        if hasattr(self, 'db_row_version'):
+            version = yield self.db_row_version(self.TABLE, row_id, self.LAST_MODIFIED_FIELD)
+            if version:
+                etag = '"{}-{}"'.format(self.TABLE, version[0])
+                if self.not_modified(etag, version[1]):
+                    return
+        row = yield self.db_get(self.TABLE, row_id)
+        if not row:
+            raise HTTPError(404)
+        self.write_json(item=row)
 
     @coroutine
     def patch(self, row_id):
@@ -140,6 +565,11 @@ def register_resources_items(self):
     resources = Registry.known('Resource')
     items = Registry.known('Item')
 
+    for handlers in list(Registry._repo.values()):
+        for handler in handlers:
+            if issubclass(handler, ValidatorMixin):
+                handler.compile_schema()
+
     for resource in resources:
         if not resource.TABLE:
             continue
@@ -152,15 +582,180 @@ def register_resources_items(self):
 
     logger.debug('Items: %s', [r.TABLE for r in items])
     for item in items:
-        if not resource.TABLE:
+        if not item.TABLE:
             continue
         if not item.URL:
             item.URL = r'^{prefix}/{res}/({id})/?$'.format(
-                prefix=resource.URL_PREFIX,
-                res=resource.TABLE,
+                prefix=item.URL_PREFIX,
+                res=item.TABLE,
                 id=SHORT_UUID_RE)
         request_repo.append(item)
 
+    batch_handlers = Registry.known('Batch') or [Batch]
+    for batch in batch_handlers:
+        if not batch.URL:
+            batch.URL = r'^{prefix}/_batch/?$'.format(prefix=batch.URL_PREFIX)
+        batch.ROUTES = [
+            (re.compile(handler.URL), handler)
+            for handler in resources + items
+            if handler.TABLE and isinstance(handler.URL, str)
+        ]
+        request_repo.append(batch)
+
+
+class _BatchConnection:
+    """ Collect response of a sub request instead of sending it """
+
+    def __init__(self, context):
+        self.context = context
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.finished = Future()
+
+    def set_close_callback(self, callback):
+        pass
+
+    def _done(self, callback):
+        if callback:
+            callback()
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        self.status = start_line.code
+        self.headers = headers
+        if chunk:
+            self.chunks.append(chunk)
+        return self._done(callback)
+
+    def write(self, chunk, callback=None):
+        self.chunks.append(chunk)
+        return self._done(callback)
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+
+class BatchAborted(Exception):
+    pass
+
+
+class Batch(ErrorMixin, JsonMixin, Request):
+    """
+    Run many ``Resource`` / ``Item`` requests in one HTTP request::
+
+        POST /api/_batch
+        {"transaction": true, "requests": [
+            {"method": "POST", "path": "/api/posts", "body": {"title": "Hi"}},
+            {"method": "GET", "path": "/api/posts?limit=10"}
+        ]}
+
+    Sub requests run in order, in process, with headers (cookies...) of the
+    batch request. Response is ``{"status": "ok", "results": [{"status": 200, "body": ...}]}``.
+
+    Mix with ``PgMixin`` so all sub requests share one database connection,
+    ``transaction`` then runs them in a single transaction, rolled back
+    and stopped at the first failed sub request (without it, asking for
+    a transaction is answered with 400)::
+
+        class ApiBatch(PgMixin, Batch):
+            pass
+    """
+
+    REPO = 'Batch'
+    URL_PREFIX = '/api'
+    ROUTES = []
+    MAX_REQUESTS = 50
+
+    def parse_batch(self):
+        data = self.data
+        if isinstance(data, dict):
+            requests, transaction = data.get('requests'), bool(data.get('transaction'))
+        else:
+            requests, transaction = data, False
+        if not isinstance(requests, list) or not all(isinstance(r, dict) for r in requests):
+            raise HTTPError(400, 'Expect a list of requests')
+        if len(requests) > self.MAX_REQUESTS:
+            raise HTTPError(400, 'Too many requests, max is {}'.format(self.MAX_REQUESTS))
+        return requests, transaction
+
+    def find_route(self, path):
+        for pattern, handler_class in self.ROUTES:
+            match = pattern.match(path)
+            if match:
+                return handler_class, match.groups()
+        return None, ()
+
+    @coroutine
+    def run_one(self, spec, connection=None, transaction=False):
+        method = str(spec.get('method', 'GET')).upper()
+        uri = str(spec.get('path', ''))
+        handler_class, args = self.find_route(uri.partition('?')[0])
+        if not handler_class:
+            return dict(status=404, body={'reason': 'Not found: ' + uri})
+
+        headers = HTTPHeaders(self.request.headers)
+        body = b''
+        if spec.get('body') is not None:
+            body = to_json(spec['body']).encode()
+            headers['Content-Type'] = 'application/json; charset=UTF-8'
+        headers['Content-Length'] = str(len(body))
+        sub_connection = _BatchConnection(getattr(self.request.connection, 'context', None))
+        request = HTTPServerRequest(
+            method=method, uri=uri, version=self.request.version,
+            headers=headers, body=body, host=self.request.host,
+            connection=sub_connection
+        )
+        handler = handler_class(self.application, request)
+        if transaction:
+            handler._pg_tx_connection = connection
+        elif connection is not None:
+            handler._pg_shared_connection = connection
+        yield handler._execute([], *args)
+        yield sub_connection.finished
+
+        content = b''.join(sub_connection.chunks)
+        content_type = sub_connection.headers.get('Content-Type', '') if sub_connection.headers else ''
+        if content and content_type.startswith('application/json'):
+            content = parse_json(content)
+        else:
+            content = content.decode('utf-8', 'replace')
+        return dict(status=sub_connection.status, body=content)
+
+    @coroutine
+    def run_all(self, requests, connection=None, atomic=False):
+        results = []
+        for spec in requests:
+            result = yield self.run_one(spec, connection, atomic)
+            results.append(result)
+            if atomic and result['status'] >= 400:
+                raise BatchAborted(results)
+        return results
+
+    @coroutine
+    def post(self):
+        requests, transaction = self.parse_batch()
+        status = 'ok'
+        if not hasattr(self, 'pg_getconn'):
+            if transaction:
+                raise HTTPError(400, 'Transactions are not supported')
+            results = yield self.run_all(requests)
+        elif transaction:
+            try:
+                results = yield self.pg_transaction(
+                    lambda: self.run_all(requests, self._pg_tx_connection, atomic=True)
+                )
+            except BatchAborted as e:
+                results, status = e.args[0], 'error'
+        else:
+            connection = yield self.pg_getconn()
+            with self.db.manage(connection):
+                results = yield self.run_all(requests, connection)
+        self.write_json(status=status, results=results)
+
 
 class PlainApi(ErrorMixin, JsonMixin, Request):
     REPO = 'Request'
@@ -175,16 +770,227 @@ class ValidationError(HTTPError):
         self.reason = 'Validation failed {}'.format(', '.join(tuple(errors.keys())))
         self.detail = errors
 
+_FAST_TYPES = {
+    'string': ((str,), ()),
+    'integer': ((int,), ()),
+    'float': ((float, int), ()),
+    'number': ((int, float), (bool,)),
+    'boolean': ((bool,), ()),
+    'dict': ((Mapping,), ()),
+    # Cerberus accepts bytes as list without checking items, let it decide
+    'list': ((Sequence,), (str, bytes, bytearray)),
+}
+_FAST_RULES = {
+    'type', 'required', 'nullable', 'empty', 'minlength', 'maxlength',
+    'min', 'max', 'allowed', 'regex', 'coerce', 'default', 'schema',
+}
+
+
+class _Invalid(Exception):
+    """ Fast path can't accept the value, Cerberus will tell why """
+
+
+def compile_schema(schema):
+    """
+    Compile a subset of Cerberus rules into a function accepting only valid
+    documents: it returns the normalized document, or None to let Cerberus
+    validate (and build exact same errors).
+
+    :return function or None if schema uses unsupported rules
+    """
+    fields = {}
+    for field, rules in schema.items():
+        check = _compile_rules(rules)
+        if check is None:
+            return None
+        fields[field] = (check, rules.get('required', False),
+                         'default' in rules, rules.get('default'))
+
+    def validate_mapping(document):
+        if not isinstance(document, Mapping):
+            raise _Invalid()
+        result = {}
+        for key in document:
+            if key not in fields:
+                raise _Invalid()
+        for field, (check, required, has_default, default) in fields.items():
+            if field in document:
+                result[field] = check(document[field], False)
+            elif has_default:
+                result[field] = check(default, True)
+            elif required:
+                raise _Invalid()
+        return result
+
+    def validate(document):
+        try:
+            return validate_mapping(document)
+        except _Invalid:
+            return None
+
+    validate.mapping = validate_mapping
+    return validate
+
+
+def _compile_rules(rules):
+    if not isinstance(rules, Mapping) or not set(rules) <= _FAST_RULES:
+        return None
+    types = rules.get('type')
+    if types is not None:
+        types = [types] if isinstance(types, str) else list(types)
+        if not all(t in _FAST_TYPES for t in types):
+            return None
+        types = [_FAST_TYPES[t] for t in types]
+    coerce = rules.get('coerce')
+    if coerce is not None and not callable(coerce):
+        return None
+    regex = rules.get('regex')
+    if regex is not None:
+        regex = re.compile(regex if regex.endswith('$') else regex + '$')
+    nullable = rules.get('nullable', False)
+    empty = rules.get('empty', True)
+    minlength, maxlength = rules.get('minlength'), rules.get('maxlength')
+    min_value, max_value = rules.get('min'), rules.get('max')
+    allowed = rules.get('allowed')
+
+    nested = None
+    if 'schema' in rules:
+        is_list = types and all(t is _FAST_TYPES['list'] for t in types)
+        is_dict = types and all(t is _FAST_TYPES['dict'] for t in types)
+        if is_dict:
+            compiled = compile_schema(rules['schema'])
+            nested = compiled and compiled.mapping
+        elif is_list:
+            item_check = _compile_rules(rules['schema'])
+            if item_check:
+
+                def nested(value):
+                    if not isinstance(value, list):
+                        # Cerberus keeps other sequence types
+                        raise _Invalid()
+                    return [item_check(v, False) for v in value]
+
+        if nested is None:
+            return None
+
+    def check(value, is_default):
+        if value is None:
+            if nullable and not is_default and coerce is None:
+                return None
+            # default replacing None, coercing None...
+            raise _Invalid()
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except Exception:
+                raise _Invalid()
+        if types is not None and not any(
+                isinstance(value, included) and not isinstance(value, excluded)
+                for included, excluded in types):
+            raise _Invalid()
+        if isinstance(value, Sized) and len(value) == 0 and (
+                not empty or allowed is not None or regex is not None or
+                minlength is not None):
+            # let Cerberus decide which rules are dropped for empty values
+            raise _Invalid()
+        try:
+            if minlength is not None and len(value) < minlength:
+                raise _Invalid()
+            if maxlength is not None and len(value) > maxlength:
+                raise _Invalid()
+            if min_value is not None and value < min_value:
+                raise _Invalid()
+            if max_value is not None and value > max_value:
+                raise _Invalid()
+        except TypeError:
+            raise _Invalid()
+        if allowed is not None:
+            if isinstance(value, Iterable) and not isinstance(value, str):
+                if not all(v in allowed for v in value):
+                    raise _Invalid()
+            elif value not in allowed:
+                raise _Invalid()
+        if regex is not None and isinstance(value, str) and not regex.match(value):
+            raise _Invalid()
+        if nested is not None:
+            value = nested(value)
+        return value
+
+    return check
+
+
+class _ValidatorView:
+    """ Result of one validation, other attributes come from the shared validator """
+
+    def __init__(self, validator, document, errors):
+        self._validator = validator
+        self.document = document
+        self.errors = errors
+
+    def __getattr__(self, name):
+        return getattr(self._validator, name)
+
+
 class ValidatorMixin:
+    """
+    Validate and coerce ``self.data`` with Cerberus ``SCHEMA``
+
+    Building a ``Validator`` parses and normalizes the schema,
+    so it's done once per class (and thread) then reused for each request.
+    Schemas using common rules are also compiled to a fast function
+    accepting valid documents, Cerberus only runs to report errors.
+
+    After ``validate()``, ``self.document`` is the normalized document and
+    ``self.validator.document`` / ``self.validator.errors`` are kept for this
+    request, even when the shared validator is used by another one.
+    """
 
     SCHEMA = None
+    _fast_validate = None
+
+    @classmethod
+    def compile_schema(cls):
+        """ Build the validator, a broken schema fails at startup instead of first request """
+        if not cls.SCHEMA:
+            return
+        cls._validator_local = threading.local()
+        cls._validator_schema = cls.SCHEMA
+        cls._validator_local.validator = Validator(cls.SCHEMA)
+        cls._fast_validate = compile_schema(cls.SCHEMA)
+
+    @classmethod
+    def get_validator(cls):
+        if cls.__dict__.get('_validator_schema') is not cls.SCHEMA:
+            # not compiled yet or SCHEMA was changed
+            cls.compile_schema()
+        local = cls._validator_local
+        validator = getattr(local, 'validator', None)
+        if validator is None:
+            # Cerberus validators keep state, so each thread has its own
+            validator = local.validator = Validator(cls.SCHEMA)
+        return validator
 
     def validate(self):
+        """
+        :return normalized document
+        :raise ValidationError:
+        """
         if not self.SCHEMA:
             raise ValueError("Cannot validate because schema isn't set")
-        self.validator = Validator(self.SCHEMA)
-        if not self.validator.validate(self.data):
-            raise ValidationError(self.validator.errors)
+        validator = self.get_validator()
+        fast_validate = type(self)._fast_validate
+        document = fast_validate(self.data) if fast_validate else None
+        if document is None:
+            valid = validator.validate(self.data)
+            # the validator is shared, keep the result of this request
+            self.validator = _ValidatorView(validator, validator.document, validator.errors)
+            if not valid:
+                raise ValidationError(self.validator.errors)
+            document = self.validator.document
+        else:
+            self.validator = _ValidatorView(validator, document, {})
+        self.document = document
+        return document
 
 
 class CreateMixin(ValidatorMixin):
@@ -196,9 +1002,9 @@ class CreateMixin(ValidatorMixin):
 
     @coroutine
     def post(self):
-        self.validate()
+        document = self.validate()
         try:
-            ret = yield self.on_create(self.validator.document)
+            ret = yield self.on_create(document)
         except self.DbIntegrityError as e:
             self.set_status(400)
             self.write_json({'reason': str(e)})
@@ -220,9 +1026,9 @@ class UpdateMixin(ValidatorMixin):
 
     @coroutine
     def put(self, uid):
-        self.validate()
+        document = self.validate()
         try:
-            changes = yield self.on_update(self.validator.document, uid)
+            changes = yield self.on_update(document, uid)
         except self.DbError as e:
             self.set_status(500)
             self.write_json({'reason': str(e)})
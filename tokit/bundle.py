@@ -0,0 +1,274 @@
+"""
+Per-page bundles: ordered ``js()`` / ``css()`` files of a handler,
+compiled if needed, minified, concatenated into one content-hashed file
+with its source map, then served by ``Assets``::
+
+    class Home(BundleMixin, Request):
+
+        def js(self):
+            yield from ['riot.js', 'home/home.coffee', 'home/home.tag']
+
+Layout gets one URL per page::
+
+    {% for url in handler.js_urls() %}
+        <script src="{{ url }}" type="text/javascript"></script>
+    {% end %}
+
+Bundles are built in the thread pool, a page gets URLs of each file
+until its bundle is ready. With ``static_hash_cache`` off, files are
+checked again at most every ``bundle_check_interval`` seconds.
+
+The source map has a section per file, pointing at its original source.
+Lines are exact for files copied as is; minified or compiled ones
+(compilers don't emit maps) are mapped to the start of their source.
+Relative ``url()`` of CSS files are rewritten for the bundle folder.
+
+Minifying needs ``rjsmin`` / ``rcssmin``, files are concatenated as is without them.
+"""
+import os
+import io
+import re
+import json
+import time
+import hashlib
+import posixpath
+import threading
+
+from tornado.ioloop import IOLoop
+
+from tokit import Assets, logger
+from tokit.utils import on
+from tokit import compiler
+import tokit.tasks  # noqa, provides app._thread_executor
+
+BUNDLE_TYPES = {
+    # extension, separator, source map comment
+    'js': ('.js', ';\n', '//# sourceMappingURL={}\n'),
+    'css': ('.css', '\n', '/*# sourceMappingURL={} */\n'),
+}
+
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]*)\1\s*\)''')
+
+
+def minify(kind, text):
+    try:
+        if kind == 'js':
+            from rjsmin import jsmin as minifier
+        else:
+            from rcssmin import cssmin as minifier
+    except ImportError:
+        return text
+    return minifier(text)
+
+
+def rebase_css_urls(text, path, folder):
+    """ Make relative ``url()`` of css file at ``path`` relative to ``folder`` instead """
+
+    def rebase(match):
+        quote, url = match.groups()
+        if not url or url.startswith(('/', '#', 'data:')) or ':' in url.split('/')[0]:
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(path), url))
+        return 'url({0}{1}{0})'.format(quote, posixpath.relpath(target, folder))
+
+    return CSS_URL_RE.sub(rebase, text)
+
+
+def _part_map(source_url, source, content, exact):
+    """
+    Source map of a part: with ``exact``, generated line n is line n
+    of source, else every generated line points to its start
+    """
+    lines = content.count('\n') + 1
+    return {
+        'version': 3,
+        'sources': [source_url],
+        'sourcesContent': [source],
+        'names': [],
+        'mappings': ';'.join(['AAAA'] + ['AACA' if exact else 'AAAA'] * (lines - 1)),
+    }
+
+
+class Bundler:
+    """
+    Build bundles into ``static_path/bundle_path``. An index file maps the
+    versions of their parts to built files, so they are built once even
+    across restarts. With ``check`` off, parts are not looked at again,
+    else at most every ``check_interval`` seconds.
+
+    ``bundle`` blocks (it may compile), ``get`` is for the IOLoop.
+    """
+
+    def __init__(self, static_path, bundle_path='bundle', static_url_prefix='/static/',
+                 debug=False, check=True, check_interval=2.0):
+        self.static_path = static_path
+        self.bundle_path = bundle_path
+        self.static_url_prefix = static_url_prefix
+        self.debug = debug
+        self.check = check
+        self.check_interval = check_interval
+        self.memo = {}
+        self.pending = set()
+        self.checked = {}
+        self.lock = threading.Lock()
+        self.index = {}
+        self.index_file = os.path.join(static_path, bundle_path, 'index.json')
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    def _compiler(self, path):
+        if path not in Assets.compiled:
+            return compiler.find_compiler(compiler.COMPILER_URLS, path)
+
+    def version(self, path):
+        handler = self._compiler(path)
+        if handler:
+            abs_path = os.path.join(self.static_path, path)
+            source = handler.read_source(abs_path)
+            return handler.cache_key(abs_path, source, handler.compile_options(abs_path, self.debug))
+        return Assets.compiled.get(path) or Assets.get_version({'static_path': self.static_path}, path)
+
+    def content(self, path):
+        handler = self._compiler(path)
+        if handler:
+            return handler.compile_cached(os.path.join(self.static_path, path), self.debug)[0]
+        with io.open(os.path.join(self.static_path, Assets.compiled.get(path, path)), encoding='utf8') as fp:
+            return fp.read()
+
+    def source(self, path):
+        """ :return: (original source, whether content is the same) """
+        handler = self._compiler(path)
+        if handler:
+            return handler.read_source(os.path.join(self.static_path, path)), False
+        if path in Assets.compiled:
+            with io.open(os.path.join(self.static_path, path), encoding='utf8') as fp:
+                return fp.read(), False
+        return None, True
+
+    def bundle(self, kind, paths, name='bundle'):
+        """ :return: path of the bundle, relative to static path """
+        paths = tuple(paths)
+        if not self.check and (kind, paths) in self.memo:
+            return self.memo[(kind, paths)]
+
+        key = compiler.CompileCache.make_key(kind, self.debug, *[p + ':' + str(self.version(p)) for p in paths])
+        built = self.index.get(key)
+        if not (built and os.path.exists(os.path.join(self.static_path, built + '.map'))):
+            built = self.build(kind, paths, name)
+            with self.lock:
+                self.index[key] = built
+                tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.index, f, indent=1, sort_keys=True)
+                os.replace(tmp_file, self.index_file)
+
+        with self.lock:
+            if built not in Assets.compiled_paths:
+                Assets.compiled_paths = Assets.compiled_paths | {built, built + '.map'}
+        self.memo[(kind, paths)] = built
+        return built
+
+    def get(self, kind, paths, name, executor):
+        """
+        Built bundle if known, else (or to check it with ``check`` on,
+        once per ``check_interval``) it is bundled in ``executor`` for next calls
+
+        :return: path of the bundle, relative to static path, or None
+        """
+        key = (kind, tuple(paths))
+        built = self.memo.get(key)
+        now = time.time()
+        if built is not None and (not self.check or now - self.checked.get(key, 0) < self.check_interval):
+            return built
+        if key not in self.pending:
+            self.pending.add(key)
+            self.checked[key] = now
+            future = executor.submit(self.bundle, kind, key[1], name)
+            IOLoop.current().add_future(future, lambda f: self._bundled(key, f))
+        return built
+
+    def _bundled(self, key, future):
+        self.pending.discard(key)
+        if future.exception():
+            logger.error('Cannot bundle %s: %r', key[1], future.exception())
+
+    def build(self, kind, paths, name):
+        ext, separator, map_comment = BUNDLE_TYPES[kind]
+        parts, sections, line = [], [], 0
+        for path in paths:
+            content = self.content(path)
+            source, exact = self.source(path)
+            if source is None:
+                source = content
+            if kind == 'css':
+                content = rebase_css_urls(content, path, self.bundle_path)
+            # minified one by one, so the map still tells which file a line is from
+            minified = minify(kind, content).rstrip('\n')
+            exact = exact and minified == content.rstrip('\n')
+            sections.append({
+                'offset': {'line': line, 'column': 0},
+                'map': _part_map(self.static_url_prefix + path, source, minified, exact),
+            })
+            parts.append(minified + separator)
+            line += minified.count('\n') + 1
+        body = ''.join(parts)
+
+        filename = '{}.{}{}'.format(name, hashlib.sha256(body.encode('utf8')).hexdigest()[:8], ext)
+        target = os.path.join(self.static_path, self.bundle_path, filename)
+        # other processes may serve them as soon as they exist, as immutable
+        for suffix, text in (('.map', json.dumps({'version': 3, 'file': filename, 'sections': sections})),
+                             ('', body + map_comment.format(filename + '.map'))):
+            tmp_file = '{}{}.{}.tmp'.format(target, suffix, os.getpid())
+            with io.open(tmp_file, 'w', encoding='utf8') as fp:
+                fp.write(text)
+            os.replace(tmp_file, target + suffix)
+        logger.info('Bundled %d files into %s', len(paths), filename)
+        return os.path.join(self.bundle_path, filename)
+
+
+class BundleMixin:
+    """ Layout gets a single bundle URL for ``js()`` and for ``css()`` """
+
+    def js_urls(self):
+        return self.bundle_urls('js', self.js())
+
+    def css_urls(self):
+        return self.bundle_urls('css', self.css())
+
+    def bundle_urls(self, kind, paths):
+        paths = list(paths)
+        bundler = getattr(self.application, 'bundler', None)
+        if bundler and paths:
+            built = bundler.get(kind, paths, self.__class__.__name__.lower(), self.application._thread_executor)
+            if built:
+                return [self.static_url(built, include_version=False)]
+        return [self.static_url(path) for path in paths]
+
+
+@on('init')
+def init_bundler(app):
+    """
+    Sample env.ini::
+
+        [app]
+        # default to not debug
+        bundle_assets=True
+        # relative to static path
+        bundle_path=bundle
+        # seconds between checks of files, when static_hash_cache is off
+        bundle_check_interval=2
+    """
+    env = app.config.env['app']
+    debug = app.settings.get('debug', False)
+    if not env.getboolean('bundle_assets', not debug):
+        return
+    app.bundler = Bundler(
+        app.settings['static_path'],
+        env.get('bundle_path', 'bundle'),
+        app.settings.get('static_url_prefix', '/static/'),
+        debug,
+        check=not app.settings.get('static_hash_cache', True),
+        check_interval=env.getfloat('bundle_check_interval', 2.0),
+    )
@@ -6,13 +6,14 @@ import shortuuid
 import cassandra
 from cassandra.cluster import Cluster
 from cassandra.cqlengine import connection as cqlengine_connection
-from cassandra.query import dict_factory
+from cassandra.query import dict_factory, SimpleStatement
 from tornado.gen import coroutine
+from tornado.web import HTTPError
 from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 
 import tokit
-from tokit.utils import cached_property
+from tokit.utils import cached_property, encode_token, decode_token
 
 logger = logging.getLogger(__name__)
 
@@ -103,6 +104,33 @@ class CassandraMixin:
         cs_future.add_callbacks(_success, _fail)
         return future
 
+    def cs_page(self, table, limit, cursor=None):
+        """
+        Paginate with Cassandra paging state
+
+        :param cursor: opaque token returned by previous page
+        :return Future of (rows, next cursor or None)
+        """
+        future = Future()
+        try:
+            paging_state = decode_token(cursor) if cursor else None
+        except ValueError:
+            raise HTTPError(400, 'Invalid cursor')
+        statement = SimpleStatement('SELECT * FROM ' + table, fetch_size=limit)
+        cs_future = self.cs_pool.execute_async(statement, paging_state=paging_state)
+
+        def _success(rows):
+            # same attribute ResultSet relies on
+            state = cs_future._paging_state if cs_future.has_more_pages else None
+            result = ([serialize(row) for row in rows], state and encode_token(state))
+            IOLoop.instance().add_callback(future.set_result, result)
+
+        def _fail(e):
+            IOLoop.instance().add_callback(future.set_exception, e)
+
+        cs_future.add_callbacks(_success, _fail)
+        return future
+
     @coroutine
     def cs_one(self, table, row_id):
         result = yield self.cs_query(
@@ -140,3 +168,4 @@ class CassandraMixin:
     db_insert = cs_insert
     db_update = cs_update
     db_one = cs_one
+    db_page = cs_page
@@ -1,45 +1,414 @@
 """
 Transform to browsers' languages
-Can serve files directly using shortcut: ``python3 -m tokit.compiler``
+Can serve files directly using shortcut: ``python3 -m tokit.compiler``,
+it watches sources and their imports, pages including
+``/_compiler/reload.js`` are told when to reload
+
+Or compile all of them ahead of time, to be served by ``Assets``::
+
+    python3 -m tokit.compiler --mode=build --src=. --dest=./build --jobs=4
 
 For Stylus, it has same requirements as Coffeescript
 """
 import os
 import io
+import re
+import sys
 import glob
+import json
+import time
+import queue
+import threading
+import hashlib
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import tornado.ioloop
 import tornado.web
+import tornado.websocket
 from tornado.iostream import IOStream
 from tornado.gen import coroutine
 from tornado.web import HTTPError
 from tornado import options as opts
 from tokit.tasks import ThreadPoolMixin, run_on_executor
 from tokit import ValidPathMixin
-from tokit.utils import on, cached_property
+from tokit.utils import on, cached_property, cached_classproperty, Event
 from tokit import logger
 
 COMPILER_URLS = []
 
+
+class CompileCache:
+    """
+    Compiled output by content hash: a memory LRU in front of a directory,
+    so unchanged sources are not compiled again, even after a restart
+    """
+
+    def __init__(self, path=None, size=256):
+        self.path = path
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        hasher = hashlib.sha256()
+        for part in parts:
+            hasher.update(part if isinstance(part, bytes) else str(part).encode('utf8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.path:
+            try:
+                with io.open(self._file(key), encoding='utf8') as fp:
+                    value = fp.read()
+            except OSError:
+                pass
+            else:
+                self.hits += 1
+                self._remember(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if self.path:
+            target = self._file(key)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(target, os.getpid())
+            with io.open(tmp_file, 'w', encoding='utf8') as fp:
+                fp.write(value)
+            os.replace(tmp_file, target)
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+IMPORT_RE = re.compile(r'^\s*@(?:import|require)\s+(.+?);?\s*$', re.M)
+
+
+class DependencyGraph:
+    """ Source -> files its output is compiled from, and the reverse """
+
+    def __init__(self):
+        self.sources = {}
+        self.dependents = collections.defaultdict(set)
+
+    def record(self, source, files):
+        for f in self.sources.get(source, ()):
+            self.dependents[f].discard(source)
+        self.sources[source] = frozenset(files)
+        for f in files:
+            self.dependents[f].add(source)
+
+    def affected(self, changed_files):
+        """ Sources to rebuild after ``changed_files`` changed """
+        affected = set()
+        for f in changed_files:
+            affected.update(self.dependents.get(f, ()))
+        return affected
+
+    def files(self):
+        return [f for f, sources in self.dependents.items() if sources]
+
+
+class MtimeIndex:
+    """ Polling file watcher: remember mtimes, report what changed since last call """
+
+    def __init__(self):
+        self.mtimes = {}
+
+    def changed(self, paths):
+        changed = []
+        for path in paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            if path in self.mtimes and self.mtimes[path] != mtime:
+                changed.append(path)
+            self.mtimes[path] = mtime
+        return changed
+
+
+class CompileError(Exception):
+    pass
+
+
+class CompileTimeout(CompileError):
+    pass
+
+
+def _compiler_worker(conn, js_library_path):
+    """ Process loop of ``CompilerPool``: load contexts once, then compile on demand """
+    compilers = {handler.__name__: handler for _, handler in make_compilers(js_library_path)}
+    for handler in compilers.values():
+        getattr(handler, 'context', None)
+    conn.send('ready')
+    while True:
+        try:
+            name, full_path, source, options = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            conn.send((True, compilers[name].transform(full_path, source, options)))
+        except Exception as e:
+            # compiler exceptions may not be picklable
+            conn.send((False, '{}: {}'.format(e.__class__.__name__, e)))
+
+
+class _CompilerProcess:
+
+    def __init__(self, js_library_path):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_compiler_worker, args=(child_conn, js_library_path), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        if not self.ready:
+            if not self.conn.poll(timeout):
+                raise CompileTimeout('Compiler worker did not start in {}s'.format(timeout))
+            self.ready = self.conn.recv() == 'ready'
+        return self.ready
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+
+class CompilerPool:
+    """
+    Long-lived processes holding preloaded compiler contexts, so compiles
+    run on all cores instead of queueing behind one runtime and the GIL.
+    ``call`` blocks, it is made from executor threads by ``compile``.
+    A crashed worker, or one busy longer than ``timeout``, is replaced.
+    """
+
+    START_TIMEOUT = 60
+
+    def __init__(self, size=2, timeout=30, js_library_path=None):
+        self.size = size
+        self.timeout = timeout
+        self.js_library_path = js_library_path
+        self.restarts = 0
+        self.idle = queue.Queue()
+        self.started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Processes are spawned on first compile, or by ``warm_up`` """
+        with self._lock:
+            if not self.started:
+                for _ in range(self.size):
+                    self.idle.put(_CompilerProcess(self.js_library_path))
+                self.started = True
+
+    def call(self, name, full_path, source, options, timeout=None):
+        if not self.started:
+            self.start()
+        worker = self.idle.get()
+        try:
+            if not worker.process.is_alive():
+                raise EOFError()
+            worker.wait_ready(self.START_TIMEOUT)
+            worker.conn.send((name, full_path, source, options))
+            if not worker.conn.poll(timeout or self.timeout):
+                raise CompileTimeout('Compiling {} took more than {}s'.format(full_path, timeout or self.timeout))
+            ok, result = worker.conn.recv()
+        except (CompileTimeout, EOFError, OSError) as e:
+            logger.warning('Restart compiler worker %s: %r', worker.process.pid, e)
+            worker.kill()
+            worker = _CompilerProcess(self.js_library_path)
+            self.restarts += 1
+            if isinstance(e, CompileTimeout):
+                raise
+            raise CompileError('Compiler worker died while compiling ' + full_path)
+        finally:
+            self.idle.put(worker)
+        if not ok:
+            raise CompileError(result)
+        return result
+
+    def close(self):
+        if self.started:
+            for _ in range(self.size):
+                self.idle.get().kill()
+
+
 class CompilerHandler(ThreadPoolMixin, ValidPathMixin, tornado.web.RequestHandler):
 
+    cache = CompileCache()
+    """ Shared by all compilers, replaced from config by ``init_complier`` """
+
+    VERSION = ''
+    """ Part of the cache key, changes with the compiler library """
+
+    OUTPUT_EXT = '.js'
+
+    pool = None
+    """ ``CompilerPool`` to compile out of process, see ``init_complier`` """
+
+    graph = DependencyGraph()
+    """ Recorded on each request, used by the watch mode of ``serve`` """
+
+    IMPORT_EXTS = ()
+    """ Extensions tried to resolve ``@import``, none to skip parsing imports """
+
     def set_default_headers(self):
         self.set_header('Server', "Static")
-        self.set_header('Cache-Control', "max-age: 2592000'")
+        self.set_header('Cache-Control', "public, max-age=2592000")
+
+    @classmethod
+    def read_source(cls, full_path):
+        with io.open(full_path, encoding='utf8') as fp:
+            return fp.read()
+
+    @classmethod
+    def compile_options(cls, full_path, debug=False):
+        """ Anything else changing the output, part of the cache key """
+        return {}
+
+    @classmethod
+    def resolve_import(cls, name, current_file):
+        base = os.path.join(os.path.dirname(current_file), name)
+        folder, basename = os.path.split(base)
+        for ext in ('',) + cls.IMPORT_EXTS:
+            for prefix in ('', '_'):
+                path = os.path.join(folder, prefix + basename + ext)
+                if os.path.isfile(path):
+                    return os.path.abspath(path)
+
+    @classmethod
+    def dependencies(cls, full_path, source=None):
+        """ Files (and folders) the output depends on, ``full_path`` first """
+        if os.path.isdir(full_path):
+            return [full_path] + sorted(os.path.join(full_path, f) for f in os.listdir(full_path))
+        found = [full_path]
+        pending = [(full_path, source)]
+        while cls.IMPORT_EXTS and pending:
+            current, content = pending.pop()
+            if content is None:
+                content = cls.read_source(current)
+            for match in IMPORT_RE.finditer(content):
+                for name in match.group(1).split(','):
+                    name = name.strip().strip('\'"')
+                    if name.startswith('url(') or '://' in name or name.endswith('.css'):
+                        continue
+                    path = cls.resolve_import(name, current)
+                    if path and path not in found:
+                        found.append(path)
+                        pending.append((path, None))
+        return found
+
+    @classmethod
+    def cache_key(cls, full_path, source, options, dependencies=None):
+        if dependencies is None:
+            dependencies = cls.dependencies(full_path, source)
+        imported = []
+        for path in dependencies[1:]:
+            if os.path.isfile(path):
+                with open(path, 'rb') as fp:
+                    imported += [path, fp.read()]
+        return CompileCache.make_key(
+            cls.__name__, cls.VERSION, sorted(options.items()),
+            os.path.splitext(full_path)[1], source, *imported
+        )
+
+    @classmethod
+    def transform(cls, full_path, source, options):
+        """ Blocking compile, shared by requests and ``build`` """
+        raise NotImplementedError
+
+    @run_on_executor
+    def compile(self, full_path, source, options):
+        if self.pool:
+            return self.pool.call(self.__class__.__name__, full_path, source, options)
+        return self.transform(full_path, source, options)
+
+    @classmethod
+    def compile_cached(cls, abs_path, debug=False):
+        """ Blocking compile through the cache, for bundles. :return: (output, key) """
+        source = cls.read_source(abs_path)
+        options = cls.compile_options(abs_path, debug)
+        key = cls.cache_key(abs_path, source, options)
+        body = cls.cache.get(key)
+        if body is None:
+            if cls.pool:
+                body = cls.pool.call(cls.__name__, abs_path, source, options)
+            else:
+                body = cls.transform(abs_path, source, options)
+            cls.cache.set(key, body)
+        return body, key
+
+    @classmethod
+    @coroutine
+    def build_cached(cls, executor, abs_path, debug=False):
+        """ Compile ``abs_path`` unless cached, for the watch mode of ``serve`` """
+        source = cls.read_source(abs_path)
+        options = cls.compile_options(abs_path, debug)
+        dependencies = cls.dependencies(abs_path, source)
+        cls.graph.record(abs_path, dependencies)
+        key = cls.cache_key(abs_path, source, options, dependencies)
+        if cls.cache.get(key) is None:
+            if cls.pool:
+                body = yield executor.submit(cls.pool.call, cls.__name__, abs_path, source, options)
+            else:
+                body = yield executor.submit(cls.transform, abs_path, source, options)
+            cls.cache.set(key, body)
 
     @coroutine
     def get(self, requested_file):
-        requested_path = requested_file.replace(self.application.settings['static_url_prefix'], '')
-        abs_path = os.path.abspath(os.path.join(self.application.root_path, requested_path))
+        prefix = self.application.settings['static_url_prefix']
+        requested_path = requested_file[len(prefix):] if requested_file.startswith(prefix) else requested_file
+        abs_path = os.path.abspath(os.path.join(self.application.root_path, requested_path.lstrip('/')))
         self.validate_absolute_path(self.application.root_path, abs_path)
-        (status, body) = yield self.execute(abs_path)
-        self.set_status(status)
+
+        source = self.read_source(abs_path)
+        options = self.compile_options(abs_path, self.settings.get('debug', False))
+        dependencies = self.dependencies(abs_path, source)
+        self.graph.record(abs_path, dependencies)
+        key = self.cache_key(abs_path, source, options, dependencies)
+        self.set_header('Etag', '"%s"' % key[:20])
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        body = self.cache.get(key)
+        if body is None:
+            (status, body) = yield self.execute(abs_path, source, options)
+            self.set_status(status)
+            if status == 200:
+                self.cache.set(key, body)
+            else:
+                self.clear_header('Etag')
         self.write(body)
 
     @coroutine
-    def execute(self, abs_path):
+    def execute(self, abs_path, source, options):
         try:
-            result = yield self.compile(abs_path)
+            result = yield self.compile(abs_path, source, options)
             return (200, result)
         except Exception as e:
             logger.exception(e)
@@ -52,7 +421,15 @@ class CompilerHandler(ThreadPoolMixin, ValidPathMixin, tornado.web.RequestHandle
                     str(e) + '*/'
                 )
 
-def init_complier(app):
+
+def make_compilers(js_library_path=None):
+    """
+    Compiler handlers usable with installed libraries
+    :return: list of (url pattern, handler class)
+    """
+    urls = []
+    js_library_path = js_library_path or os.path.join(os.path.dirname(__file__), 'js')
+
     try:
         import execjs
         has_execjs = True
@@ -61,16 +438,20 @@ def init_complier(app):
 
     if has_execjs:
 
-        try:
-            js_library_path = app.config.env['compiler'].get('js_library_path')
-        except KeyError:
-            js_library_path = os.path.join(os.path.dirname(__file__), 'js')
-
         def read_file(filename):
             full_path = os.path.join(js_library_path, filename)
             with io.open(full_path, encoding='utf8') as fp:
                 return fp.read()
 
+        def library_version(*filenames):
+            return CompileCache.make_key(*[read_file(f) for f in filenames])[:12]
+
+        def load_context(name, source):
+            started = time.time()
+            context = execjs.get().compile(source)
+            logger.info('Loaded %s context in %.2fs', name, time.time() - started)
+            return context
+
         class JavascriptHandler(CompilerHandler):
 
             def prepare(self):
@@ -78,34 +459,59 @@ def init_complier(app):
 
         class CoffeeHandler(JavascriptHandler):
 
-            context = execjs.get().compile(read_file('coffee-script.js'))
+            @cached_classproperty
+            def context(cls):
+                return load_context(cls.__name__, read_file('coffee-script.js'))
 
-            @run_on_executor
-            def compile(self, full_path):
-                return self.context.call(
-                    "CoffeeScript.compile",
-                    read_file(full_path),
-                    {'bare': True}
-                )
+            @cached_classproperty
+            def VERSION(cls):
+                return library_version('coffee-script.js')
+
+            @classmethod
+            def compile_options(cls, full_path, debug=False):
+                return {'bare': True}
+
+            @classmethod
+            def transform(cls, full_path, source, options):
+                return cls.context.call("CoffeeScript.compile", source, options)
 
         class StylusHandler(JavascriptHandler):
 
-            context = execjs.get().compile(read_file('stylus.js'))
+            @cached_classproperty
+            def context(cls):
+                return load_context(cls.__name__, read_file('stylus.js'))
+
+            @cached_classproperty
+            def VERSION(cls):
+                return library_version('stylus.js')
+            OUTPUT_EXT = '.css'
+            IMPORT_EXTS = ('.styl', '.css')
 
             def prepare(self):
                 self.set_header('Content-Type', 'text/css')
 
-            @run_on_executor
-            def compile(self, full_path):
-                # TODO add context to Stylus to utilize mixins and imports
-                # http://stylus-lang.com/docs/import.html#javascript-import-api
-                #   .set('filename', __dirname + '/test.styl')
-                #   .set('paths', paths)
-                return self.context.call('stylus.render', read_file(full_path))
+            @classmethod
+            def inline_imports(cls, full_path, source, seen=()):
+                """ The browser build of Stylus can't read files: paste imported ones in place """
+                def _inline(match):
+                    inlined = []
+                    for name in match.group(1).split(','):
+                        path = cls.resolve_import(name.strip().strip('\'"'), full_path)
+                        if not path or not path.endswith('.styl'):
+                            return match.group(0)
+                        if path not in seen:
+                            inlined.append(cls.inline_imports(path, cls.read_source(path), seen + (full_path,)))
+                    return '\n'.join(inlined)
+                return IMPORT_RE.sub(_inline, source)
+
+            @classmethod
+            def transform(cls, full_path, source, options):
+                return cls.context.call('stylus.render', cls.inline_imports(full_path, source))
 
         class RiotHandler(JavascriptHandler):
 
-            def _context():
+            @cached_classproperty
+            def context(cls):
                 with io.StringIO() as buffer:
                     buffer.write(read_file('coffee-script.js'))
                     buffer.write(read_file('riot-compiler.js'))
@@ -114,21 +520,26 @@ def init_complier(app):
                     # Riot custom language
                     buffer.write(read_file('stylus.js'))
                     buffer.write('riot.parsers.css.stylus = function(tagName, css) { return stylus.render(css) };')
-                    return execjs.get().compile(buffer.getvalue())
-                    
-            context = _context()
+                    return load_context(cls.__name__, buffer.getvalue())
 
-            @run_on_executor
-            def compile(self, full_path):
+            @cached_classproperty
+            def VERSION(cls):
+                return library_version('coffee-script.js', 'riot-compiler.js', 'stylus.js')
+
+            @classmethod
+            def read_source(cls, full_path):
                 if os.path.isdir(full_path):
-                    content = self.read_folder(full_path)
-                else:
-                    content = read_file(full_path)
-                return self.context.call(
-                    "riot.compile", content, True
+                    return cls.read_folder(full_path)
+                return read_file(full_path)
+
+            @classmethod
+            def transform(cls, full_path, source, options):
+                return cls.context.call(
+                    "riot.compile", source, True
                 )
 
-            def read_folder(self, folder):
+            @classmethod
+            def read_folder(cls, folder):
                 """ support a folder composed of html, css, js and preprocessors """
                 tag_name = os.path.basename(os.path.splitext(folder)[0])
                 with io.StringIO() as buffer:
@@ -156,9 +567,7 @@ def init_complier(app):
 
         class BabelHandler(JavascriptHandler):
 
-            context = execjs.get().compile(
-                    read_file('babel.js') +
-                    """;
+            wrapper = """;
                     var __babel = (global.Babel || module.exports).transform;
                     function jsx2js(raw, pragma = 'React.createElement') {
                         var opts = {
@@ -170,21 +579,27 @@ def init_complier(app):
                         return __babel(raw, { presets: ['es2015'] }).code;
                     }
                     """
-                )
+            @cached_classproperty
+            def context(cls):
+                return load_context(cls.__name__, read_file('babel.js') + cls.wrapper)
+
+            @cached_classproperty
+            def VERSION(cls):
+                return CompileCache.make_key(library_version('babel.js'), cls.wrapper)[:12]
 
-            @run_on_executor
-            def compile(self, full_path):
+            @classmethod
+            def transform(cls, full_path, source, options):
                 if full_path.endswith('.jsx'):
                     transfom = 'jsx2js'
                 elif full_path.endswith('.es'):
                     transfom = 'es2js'
-                return self.context.call(transfom, read_file(full_path))
+                return cls.context.call(transfom, source)
+
+        urls.append((r'^(/.+\.styl)$', StylusHandler))
+        urls.append((r'^(/.+\.coffee)$', CoffeeHandler))
+        urls.append((r'^(/.+\.tag)$', RiotHandler))
+        urls.append((r'^(/.+\.(?:jsx|es))$', BabelHandler))
 
-        COMPILER_URLS.append((r'^(/.+\.styl)$', StylusHandler))
-        COMPILER_URLS.append((r'^(/.+\.coffee)$', CoffeeHandler))
-        COMPILER_URLS.append((r'^(/.+\.tag)$', RiotHandler))
-        COMPILER_URLS.append((r'^(/.+\.(?:jsx|es))$', BabelHandler))
-    
     try:
         import sass
         has_sass = True
@@ -193,30 +608,196 @@ def init_complier(app):
 
     if has_sass:
         class SassHandler(CompilerHandler):
-    
+
+            VERSION = '{}-{}'.format(sass.__version__, getattr(sass, 'libsass_version', ''))
+            OUTPUT_EXT = '.css'
+            IMPORT_EXTS = ('.sass', '.scss', '.css')
+
             def prepare(self):
                 self.set_header('Content-Type', 'text/css')
-    
-            @run_on_executor
-            def compile(self, full_path):
-                return sass.compile(
-                    filename=full_path,
-                    output_style=('nested' if self.application.settings['debug'] else 'compressed')
-                )
-    
-        COMPILER_URLS.append((r'^(/.+\.sass)$', SassHandler))
-    
+
+            @classmethod
+            def compile_options(cls, full_path, debug=False):
+                return {'output_style': 'nested' if debug else 'compressed'}
+
+            @classmethod
+            def transform(cls, full_path, source, options):
+                return sass.compile(filename=full_path, **options)
+
+        urls.append((r'^(/.+\.sass)$', SassHandler))
+
+    return urls
+
+
+def find_compiler(compilers, path):
+    """ Handler class for a path relative to source root """
+    for pattern, handler in compilers:
+        if re.match(pattern, '/' + path):
+            return handler
+
+
+def init_complier(app):
+    """
+    Sample env.ini::
+
+        [compiler]
+        # relative to project root, empty to keep compiled files in memory only
+        cache_path=../tmp/compiler
+        cache_size=256
+        # compiler processes, 0 to compile in executor threads
+        workers=2
+        # seconds, a worker compiling longer is restarted
+        timeout=30
+        # False when assets are built ahead of time: no compiler is loaded
+        enabled=True
+        # load compilers in background after start, instead of on first compile
+        warm_up=False
+    """
+    try:
+        compiler_env = app.config.env['compiler']
+    except KeyError:
+        compiler_env = {}
+    if not app.config.env.getboolean('compiler', 'enabled', fallback=True):
+        logger.info('Compilers are disabled')
+        return
+
+    started = time.time()
+    cache_path = compiler_env.get('cache_path', '../tmp/compiler')
+    if cache_path:
+        cache_path = os.path.join(app.config.root_path, cache_path)
+    CompilerHandler.cache = CompileCache(cache_path, int(compiler_env.get('cache_size', 256)))
+
+    js_library_path = compiler_env.get('js_library_path')
+    COMPILER_URLS.extend(make_compilers(js_library_path))
+    workers = int(compiler_env.get('workers', 2))
+    if workers and COMPILER_URLS:
+        CompilerHandler.pool = CompilerPool(workers, float(compiler_env.get('timeout', 30)), js_library_path)
     if len(COMPILER_URLS):
         app.add_handlers('.*$', COMPILER_URLS)
         app.root_path = app.config.root_path
     else:
         logger.warn('Found no compilers handlers')
+    logger.info('Compilers registered in %.3fs, loaded on first use', time.time() - started)
+
+    if app.config.env.getboolean('compiler', 'warm_up', fallback=False):
+        def _warm_up(app):
+            app._thread_executor.submit(warm_up)
+        Event.get('start').attach(_warm_up)
+
+
+def warm_up():
+    """ Load compiler contexts (or start the pool) now rather than on first compile """
+    started = time.time()
+    if CompilerHandler.pool:
+        CompilerHandler.pool.start()
+        for _ in range(CompilerHandler.pool.size):
+            worker = CompilerHandler.pool.idle.get()
+            try:
+                worker.wait_ready(CompilerPool.START_TIMEOUT)
+            except (CompileTimeout, EOFError, OSError) as e:
+                # replaced on its first compile
+                logger.warning('Compiler worker %s failed to start: %r', worker.process.pid, e)
+            finally:
+                CompilerHandler.pool.idle.put(worker)
+    else:
+        for _, handler in COMPILER_URLS:
+            getattr(handler, 'context', None)
+    logger.info('Compilers warmed up in %.2fs', time.time() - started)
+
+RELOAD_JS = """
+(function() {
+    var ws = new WebSocket((location.protocol == 'https:' ? 'wss://' : 'ws://') + location.host + '/_compiler/reload');
+    ws.onmessage = function(e) {
+        var changed = JSON.parse(e.data).changed;
+        var links = document.querySelectorAll('link[rel=stylesheet]');
+        var css = changed.filter(function(url) { return /\\.(styl|sass|scss)$/.test(url) });
+        if (css.length != changed.length) return location.reload();
+        Array.prototype.forEach.call(links, function(link) {
+            css.forEach(function(url) {
+                if (link.href.indexOf(url) >= 0) link.href = url + '?t=' + Date.now();
+            });
+        });
+    };
+})();
+"""
+
+
+class ReloadSocket(tornado.websocket.WebSocketHandler):
+    """ Tell browsers which assets changed, include ``/_compiler/reload.js`` to listen """
+
+    clients = set()
+
+    def open(self):
+        self.clients.add(self)
+
+    def on_close(self):
+        self.clients.discard(self)
+
+    @classmethod
+    def broadcast(cls, urls):
+        message = json.dumps({'changed': sorted(urls)})
+        for client in list(cls.clients):
+            try:
+                client.write_message(message)
+            except tornado.websocket.WebSocketClosedError:
+                cls.clients.discard(client)
+
+
+class ReloadScript(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header('Content-Type', 'application/javascript')
+        self.write(RELOAD_JS)
+
+
+def watch(app, interval=0.5):
+    """
+    Poll mtimes of every file in the dependency graph, rebuild only the
+    sources depending on changed ones, then notify ``ReloadSocket``
+    """
+    index = MtimeIndex()
+    executor = app._thread_executor
+    busy = []
+
+    @coroutine
+    def _poll():
+        if busy:
+            return
+        changed = index.changed(CompilerHandler.graph.files())
+        if not changed:
+            return
+        busy.append(True)
+        try:
+            urls = []
+            for abs_path in CompilerHandler.graph.affected(changed):
+                rel_path = os.path.relpath(abs_path, app.root_path)
+                handler = find_compiler(COMPILER_URLS, rel_path)
+                try:
+                    yield handler.build_cached(executor, abs_path, debug=True)
+                except Exception as e:
+                    logger.error('Failed to compile %s: %s', rel_path, e)
+                urls.append(app.settings['static_url_prefix'] + rel_path)
+            logger.info('Changed: %s', ', '.join(urls))
+            ReloadSocket.broadcast(urls)
+        finally:
+            busy.clear()
+
+    tornado.ioloop.PeriodicCallback(_poll, interval * 1000).start()
+
 
 def serve():
-    app = tornado.web.Application(COMPILER_URLS)
-    app.root_path = opts.options.src
+    COMPILER_URLS.extend(make_compilers(opts.options.js_library_path))
+    urls = [
+        (r'/_compiler/reload', ReloadSocket),
+        (r'/_compiler/reload.js', ReloadScript),
+    ] + COMPILER_URLS
+    app = tornado.web.Application(urls, static_url_prefix='/static/', debug=True, autoreload=False)
+    app.root_path = os.path.abspath(opts.options.src)
+    app._thread_executor = ThreadPoolExecutor(opts.options.jobs)
+    if opts.options.watch:
+        watch(app, opts.options.watch_interval)
     print("Serving via compiler in: ", app.root_path)
-    print("URL: %s:%s", (opts.options.port, opts.options.host))
+    print("URL: http://%s:%s/static/" % (opts.options.host, opts.options.port))
     app.listen(opts.options.port, opts.options.host)
     tornado.ioloop.IOLoop.current().start()
 
@@ -226,9 +807,95 @@ def scan_compilable_files():
         targets = glob.glob(opts.options.src + '/**/*.' + ext, recursive=True)
         yield from targets
 
-def build():
-    # run server
-    opts.options.src
+BUILD_MANIFEST = 'compiled.json'
+""" Written in ``--dest``: source path -> built path, read by ``Assets`` """
+
+_build_compilers = None
+
+
+def _init_build_worker(js_library_path):
+    global _build_compilers
+    _build_compilers = make_compilers(js_library_path)
+
+
+def _build_file(src, dest, rel_path):
+    """ Compile in a pool process, output is named by its content hash """
+    handler = find_compiler(_build_compilers, rel_path)
+    full_path = os.path.join(src, rel_path)
+    output = handler.transform(full_path, handler.read_source(full_path), handler.compile_options(full_path))
+    digest = hashlib.sha256(output.encode('utf8')).hexdigest()[:8]
+    built = '{}.{}{}'.format(rel_path, digest, handler.OUTPUT_EXT)
+    target = os.path.join(dest, built)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with io.open(target + '.tmp', 'w', encoding='utf8') as fp:
+        fp.write(output)
+    os.replace(target + '.tmp', target)
+    return built
+
+
+def build(jobs=None, js_library_path=None):
+    """
+    Compile every source in ``--src`` to ``--dest`` (default ``build``
+    within ``--src``) with a process pool. Sources whose cache key (content, compiler version, options) is
+    unchanged since last build are skipped.
+
+    :return: number of failed files
+    """
+    src = os.path.abspath(opts.options.src)
+    dest = os.path.abspath(opts.options.dest or os.path.join(src, 'build'))
+    manifest_file = os.path.join(dest, BUILD_MANIFEST)
+    started = time.time()
+
+    previous = {'assets': {}, 'keys': {}}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            previous = json.load(f)
+    assets, keys = {}, {}
+
+    compilers = make_compilers(js_library_path)
+    pending = {}
+    for full_path in scan_compilable_files():
+        full_path = os.path.abspath(full_path)
+        rel_path = os.path.relpath(full_path, src)
+        if (dest != src and full_path.startswith(dest + os.sep)) or not os.path.basename(full_path)[0].isalpha():
+            # partials (_mixins.sass...) can't be served alone
+            continue
+        handler = find_compiler(compilers, rel_path)
+        if not handler:
+            continue
+        key = handler.cache_key(full_path, handler.read_source(full_path), handler.compile_options(full_path))
+        built = previous['assets'].get(rel_path)
+        if previous['keys'].get(rel_path) == key and built and os.path.exists(os.path.join(dest, built)):
+            assets[rel_path], keys[rel_path] = built, key
+        else:
+            pending[rel_path] = key
+
+    failed = 0
+    if pending:
+        with ProcessPoolExecutor(jobs, initializer=_init_build_worker, initargs=(js_library_path,)) as pool:
+            futures = {pool.submit(_build_file, src, dest, rel_path): rel_path for rel_path in pending}
+            for future in as_completed(futures):
+                rel_path = futures[future]
+                try:
+                    assets[rel_path] = future.result()
+                    keys[rel_path] = pending[rel_path]
+                    print('Built', rel_path, '->', assets[rel_path])
+                except Exception as e:
+                    failed += 1
+                    logger.error('Failed to compile %s: %s', rel_path, e)
+
+    # outputs of changed or removed sources
+    for rel_path, built in previous['assets'].items():
+        if assets.get(rel_path) != built and os.path.exists(os.path.join(dest, built)):
+            os.remove(os.path.join(dest, built))
+
+    os.makedirs(dest, exist_ok=True)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({'assets': assets, 'keys': keys}, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    print('Compiled {} files, {} unchanged, {} failed in {:.2f}s'.format(
+        len(pending) - failed, len(assets) - len(pending) + failed, failed, time.time() - started))
+    return failed
 
 def main():
     pwd = os.path.realpath(os.path.curdir)
@@ -236,13 +903,17 @@ def main():
     opts.define('port', default='8080')
     opts.define('host', default='::1')
     opts.define('src', default=pwd)
-    opts.define('dest', default=pwd)
+    opts.define('dest', default=None)
+    opts.define('jobs', default=os.cpu_count(), type=int)
+    opts.define('js_library_path', default=None)
+    opts.define('watch', default=True, type=bool)
+    opts.define('watch_interval', default=0.5, type=float)
     opts.parse_command_line()
 
     if opts.options.mode == 'serve':
         serve()
     elif opts.options.mode == 'build':
-        build()
+        sys.exit(1 if build(opts.options.jobs, opts.options.js_library_path) else 0)
 
 if __name__ == "__main__":
     main()
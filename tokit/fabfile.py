@@ -291,6 +291,12 @@ def static_copy():
     run('chown -R nginx /var/www/{app}/'.format(path=env.x.remote_path, app=env.x.app))
 
 
+def static_compress(path='src/static'):
+    """ Build .br / .gz siblings of static files, served by Assets """
+    from tokit import precompress_assets
+    print(green('Compressed %d files' % precompress_assets(path)))
+
+
 def systemd_reload():
     with_root()
     run('systemctl daemon-reload')
@@ -1,16 +1,33 @@
+import io
+import re
+import json
+import sys
+import time
 import logging
+import functools
+import itertools
+import collections
 import shortuuid
 import uuid
+from datetime import timedelta
 
 import momoko
 import momoko.exceptions
 import psycopg2
 from psycopg2.extras import DictCursor, DictRow, register_uuid
 import psycopg2.extensions
+from psycopg2.errorcodes import (
+    DUPLICATE_PREPARED_STATEMENT, INVALID_SQL_STATEMENT_NAME as INVALID_STATEMENT_NAME,
+    FEATURE_NOT_SUPPORTED, INDETERMINATE_DATATYPE, AMBIGUOUS_PARAMETER, SYNTAX_ERROR
+)
 
 from tornado.gen import coroutine, sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Condition
 from tornado.web import HTTPError
 import tokit
+import tokit.tasks  # noqa, provides app._thread_executor
+from tokit.utils import to_json, md5, encode_token, decode_token
 
 logger = tokit.logger
 
@@ -32,6 +49,29 @@ def pg_init(app):
         [postgres]
         dsn=dbname=[APP_NAME]
         size=2
+        prepared_cache_size=100
+        # prepared statements per connection, 0 to disable
+
+    Optional read replicas, used by ``pg_select`` and ``pg_one``::
+
+        replicas=
+            host=replica1 dbname=[APP_NAME]
+            host=replica2 dbname=[APP_NAME]
+        read_your_writes=True
+        # a request reads from primary after it wrote
+        replica_max_lag=10
+        # seconds, lagging replica is taken out of rotation
+        replica_check_sec=5
+
+    Optional result cache for ``pg_select(..., cache=ttl)``,
+    invalidated across processes with NOTIFY::
+
+        result_cache_mb=64
+
+    Optional version counter per table, bumped by writes,
+    used for ETag of ``Resource`` listings::
+
+        table_versions=True
     """
     env = app.config.env['postgres']
     if env.getboolean('log_momoko'):
@@ -45,12 +85,359 @@ def pg_init(app):
         # connection_factory=env.get('connection_factory', None),
     )
     register_uuid()
+    app.pg_prepared_cache_size = env.getint('prepared_cache_size', 100)
     app.pg_db = momoko.Pool(**momoko_opts)
     try:
         app.pg_db.connect()
     except momoko.PartiallyConnectedError:
         logger.error('Cannot connect')
 
+    app.pg_result_cache = None
+    cache_mb = env.getfloat('result_cache_mb', 0)
+    if cache_mb > 0:
+        cache = app.pg_result_cache = ResultCache(int(cache_mb * 1024 * 1024))
+        pg_listen(env['dsn'], cache.CHANNEL, lambda notifies: [
+            cache.invalidate(n.payload) for n in notifies
+        ], on_reconnect=cache.clear)
+
+    app.pg_table_versions = env.getboolean('table_versions', False)
+    if app.pg_table_versions:
+        IOLoop.current().spawn_callback(pg_setup_versions, app)
+
+    app.pg_replicas = []
+    app.pg_read_your_writes = env.getboolean('read_your_writes', True)
+    replicas = [dsn.strip() for dsn in env.get('replicas', '').strip().split('\n') if dsn.strip()]
+    for dsn in replicas:
+        replica = ReplicaPool(dsn, momoko.Pool(**dict(momoko_opts, dsn=dsn)))
+        try:
+            replica.pool.connect()
+        except momoko.PartiallyConnectedError:
+            logger.error('Cannot connect replica %s', dsn)
+            replica.healthy = False
+        app.pg_replicas.append(replica)
+
+    app.pg_replica_max_lag = env.getfloat('replica_max_lag', 10)
+    if app.pg_replicas:
+        check_callback = PeriodicCallback(
+            lambda: pg_check_replicas(app, app.pg_replica_max_lag),
+            env.getfloat('replica_check_sec', 5) * 1000
+        )
+        check_callback.start()
+
+
+def pg_listen(dsn, channel, callback, on_reconnect=None):
+    """
+    A dedicated connection (outside of pool) waiting for notifications
+    http://initd.org/psycopg/docs/advanced.html#asynchronous-notifications
+
+    :param callback: called with list of ``Notify``
+    :param on_reconnect: called after the connection was lost then restored,
+        notifications sent meanwhile are missed
+    :return PgListener
+    """
+    listener = PgListener(dsn, channel, callback, on_reconnect)
+    listener.connect()
+    return listener
+
+
+class PgListener:
+    """ LISTEN on a channel, reconnecting with backoff when the connection drops """
+
+    MAX_BACKOFF = 60
+
+    def __init__(self, dsn, channel, callback, on_reconnect=None):
+        self.dsn = dsn
+        self.channel = channel
+        self.callback = callback
+        self.on_reconnect = on_reconnect
+        self.connection = None
+        self.backoff = 1
+        self.lost = False
+        self.closed = False
+
+    def connect(self):
+        if self.closed:
+            return
+        try:
+            connection = psycopg2.connect(self.dsn)
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            connection.cursor().execute('LISTEN ' + self.channel)
+        except psycopg2.Error as e:
+            logger.error('Cannot LISTEN %s, retry in %ds: %s', self.channel, self.backoff, e)
+            IOLoop.current().call_later(self.backoff, self.connect)
+            self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+            return
+        self.connection = connection
+        self.backoff = 1
+        IOLoop.current().add_handler(connection.fileno(), self._on_notify, IOLoop.READ)
+        if self.lost:
+            self.lost = False
+            logger.info('LISTEN %s reconnected', self.channel)
+            if self.on_reconnect:
+                self.on_reconnect()
+
+    def _on_notify(self, fd, events):
+        connection = self.connection
+        try:
+            connection.poll()
+        except psycopg2.Error as e:
+            logger.warning('LISTEN %s connection lost: %s', self.channel, e)
+            self._disconnect()
+            self.lost = True
+            self.connect()
+            return
+        if connection.notifies:
+            notifies = connection.notifies[:]
+            del connection.notifies[:]
+            self.callback(notifies)
+
+    def _disconnect(self):
+        connection, self.connection = self.connection, None
+        if not connection:
+            return
+        try:
+            IOLoop.current().remove_handler(connection.fileno())
+        except (ValueError, KeyError, psycopg2.Error):
+            # fd may already be invalid
+            pass
+        connection.close()
+
+    def close(self):
+        self.closed = True
+        self._disconnect()
+
+
+class ResultCache:
+    """
+    LRU cache of query results with TTL and a memory cap.
+    Each entry is tagged with tables it reads, so a write to a table
+    drops all related entries.
+    """
+
+    CHANNEL = 'tokit_cache'
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.tags = collections.defaultdict(set)
+        self.stats = collections.Counter()
+        self.invalidated = {}
+        """ Last invalidation time of tables, ``None`` key for all """
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['miss'] += 1
+            return None
+        expires, size, tables, rows = entry
+        if expires < time.time():
+            self.stats['expired'] += 1
+            self.stats['miss'] += 1
+            self.remove(key)
+            return None
+        self.stats['hit'] += 1
+        self.entries.move_to_end(key)
+        return rows
+
+    def set(self, key, rows, ttl, tables):
+        size = _estimate_size(rows)
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        while self.entries and self.size + size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.stats['eviction'] += 1
+        self.entries[key] = (time.time() + ttl, size, tables, rows)
+        self.size += size
+        for table in tables:
+            self.tags[table].add(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, tables, _ = entry
+        self.size -= size
+        for table in tables:
+            keys = self.tags.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[table]
+
+    def clear(self):
+        """ Drop all entries, when invalidations may have been missed """
+        self.entries.clear()
+        self.tags.clear()
+        self.size = 0
+        self.invalidated[None] = time.time()
+
+    def invalidate(self, table):
+        self.invalidated[table] = time.time()
+        keys = self.tags.pop(table, ())
+        for key in list(keys):
+            self.remove(key)
+        if keys:
+            self.stats['invalidation'] += 1
+
+    def invalidated_since(self, tables, since):
+        """ :return True if one of tables was invalidated after ``since`` """
+        return any(self.invalidated.get(table, 0) > since for table in tables + [None])
+
+    def info(self):
+        return dict(self.stats, entries=len(self.entries), bytes=self.size)
+
+
+def _estimate_size(rows):
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+        for row in rows
+    )
+
+
+_READ_TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+([\w."]+)', re.IGNORECASE)
+_WRITE_TABLE_RE = re.compile(
+    r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)\s+(?:ONLY\s+)?([\w."]+)',
+    re.IGNORECASE
+)
+
+
+def _table_name(name):
+    return name.replace('"', '').split('.')[-1].lower()
+
+
+@coroutine
+def pg_setup_versions(app):
+    yield app.pg_db.execute("""
+        CREATE TABLE IF NOT EXISTS tokit_table_versions (
+            name text PRIMARY KEY,
+            version bigint NOT NULL DEFAULT 1,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        )
+    """)
+
+
+class ReplicaPool:
+    """ A read replica and its number of in-flight queries """
+
+    LAG_SQL = """
+        SELECT CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """
+
+    def __init__(self, dsn, pool):
+        self.dsn = dsn
+        self.pool = pool
+        self.outstanding = 0
+        self.healthy = True
+
+
+@coroutine
+def pg_check_replicas(app, max_lag):
+    """ Take lagging or broken replicas out of rotation, put back recovered ones """
+    for replica in app.pg_replicas:
+        try:
+            cursor = yield replica.pool.execute(replica.LAG_SQL)
+            lag = cursor.fetchone()[0] or 0
+        except (psycopg2.Error, momoko.Pool.DatabaseNotAvailable,
+                momoko.exceptions.PartiallyConnectedError) as e:
+            lag = None
+            logger.debug('Replica check failed %s: %s', replica.dsn, e)
+        healthy = lag is not None and lag <= max_lag
+        if healthy != replica.healthy:
+            logger.warning('Replica %s is %s (lag: %s)', replica.dsn,
+                           'back' if healthy else 'out of rotation', lag)
+        replica.healthy = healthy
+
+
+pg_stats = collections.Counter()
+""" Counters of prepared statements: ``prepared_hit``, ``prepared_miss``, ``prepared_evict``, ``prepared_fail`` """
+
+_PLACEHOLDER_RE = re.compile(r'%[s%]')
+_PREPARABLE = ('select', 'insert', 'update', 'delete', 'with', 'values')
+# a tuple parameter is a list of values, not a single parameter
+_IN_PLACEHOLDER_RE = re.compile(r'\bIN\s*%s', re.IGNORECASE)
+
+_unpreparable = set()
+""" Names of statements PREPARE can never work for, e.g. parameter of unknown type """
+
+_UNPREPARABLE_CODES = (INDETERMINATE_DATATYPE, AMBIGUOUS_PARAMETER, SYNTAX_ERROR)
+
+
+@functools.lru_cache(maxsize=1024)
+def _prepare_sql(query):
+    """
+    Convert a query with ``%s`` placeholders to a PREPARE statement
+
+    :return (name, PREPARE statement, number of params) or None if not preparable
+    """
+    sql = query.strip().rstrip(';')
+    if ';' in sql or '%(' in sql or not sql.lower().startswith(_PREPARABLE):
+        return None
+    if _IN_PLACEHOLDER_RE.search(sql):
+        return None
+    if "'" not in sql and '"' not in sql:
+        # same statement with different indentation shares a plan
+        sql = ' '.join(sql.split())
+    counter = itertools.count(1)
+    body = _PLACEHOLDER_RE.sub(
+        lambda m: '%' if m.group() == '%%' else '${}'.format(next(counter)), sql
+    )
+    name = 'tokit_' + md5(sql)[:16]
+    return name, 'PREPARE {} AS {}'.format(name, body), next(counter) - 1
+
+
+@functools.lru_cache(maxsize=256)
+def _insert_sql(table, fields):
+    return 'INSERT INTO {} ({}) VALUES ({}) RETURNING id '.format(
+        table, ','.join(fields), ','.join(['%s'] * len(fields))
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _update_sql(table, fields):
+    changes = [field + ' = %s' for field in fields]
+    return 'UPDATE {} SET {} WHERE id = %s'.format(table, ','.join(changes))
+
+
+def _array_literal(values):
+    """ Postgres array literal of a (nested) list """
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        elif isinstance(value, (list, tuple)):
+            items.append(_array_literal(value))
+        else:
+            if isinstance(value, bool):
+                value = 't' if value else 'f'
+            elif isinstance(value, (bytes, bytearray, memoryview)):
+                value = '\\x' + bytes(value).hex()
+            items.append('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+
+def _copy_value(value, sql_type=''):
+    """ Format a value for COPY text format, ``sql_type`` tells how to write a list """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + bytes(value).hex()
+    elif isinstance(value, (list, tuple)) and sql_type.endswith('[]'):
+        value = _array_literal(value)
+    elif isinstance(value, (dict, list, tuple)):
+        value = to_json(value)
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
 
 class PgMixin:
 
@@ -76,13 +463,9 @@ class PgMixin:
         else:
             fields = list(data.keys())
         assert len(data) > 0  # check data
-        values = list(data.values())
+        values = [data[f] for f in fields]
 
-        sql = 'INSERT INTO {} ({}) VALUES ({}) RETURNING id ' \
-            .format(table,
-                    ','.join(fields),
-                    ','.join(['%s'] * len(fields))
-                    )
+        sql = _insert_sql(table, tuple(fields))
         cursor = yield self.pg_query(sql, *values)
         return cursor.fetchone()[0]
 
@@ -105,20 +488,477 @@ class PgMixin:
     @coroutine
     def pg_update(self, table, data):
         id_value = data.pop('id')
-        changes = [field + ' = %s' for field in data.keys()]
-        sql = 'UPDATE {} SET {} WHERE id = %s'.format(table, ','.join(changes))
+        sql = _update_sql(table, tuple(data.keys()))
         values = list(data.values()) + [id_value]
         cursor = yield self.pg_query(sql, *values)
         return cursor
 
+    BULK_BATCH_SIZE = 500
+    """ Rows per multi-row VALUES statement """
+
+    BULK_COPY_THRESHOLD = 2000
+    """ From this number of rows, bulk operations use COPY FROM STDIN """
+
+    _pg_column_types = {}
+
+    @coroutine
+    def pg_column_types(self, table):
+        """
+        :return dict column name -> SQL type, cached per process
+        """
+        types = self._pg_column_types.get(table)
+        if types is None:
+            result = yield self.pg_query("""
+                SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+            """, table)
+            types = PgMixin._pg_column_types[table] = dict(result.fetchall())
+        return types
+
+    @coroutine
+    def _pg_bulk_fields(self, table, rows):
+        """
+        Fields of rows, which must all have the same keys, all columns of ``table``
+        (they come from clients and are written in SQL)
+
+        :return (fields, column types)
+        """
+        if not all(isinstance(row, dict) for row in rows):
+            raise HTTPError(400, 'Rows must be objects')
+        fields = list(rows[0].keys())
+        keys = set(fields)
+        if not fields or any(row.keys() != keys for row in rows):
+            raise HTTPError(400, 'Rows must have same fields')
+        types = yield self.pg_column_types(table)
+        unknown = keys.difference(types)
+        if unknown:
+            raise HTTPError(400, 'Unknown fields: ' + ', '.join(sorted(unknown)))
+        return fields, types
+
+    @staticmethod
+    def _conflict_sql(fields, conflict, update):
+        if not conflict:
+            return ''
+        update = [f for f in (update or fields) if f not in conflict]
+        if not update:
+            return ' ON CONFLICT ({}) DO NOTHING'.format(','.join(conflict))
+        return ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            ','.join(conflict),
+            ','.join('{0} = EXCLUDED.{0}'.format(f) for f in update)
+        )
+
+    @coroutine
+    def _pg_values_insert(self, table, fields, rows, suffix, returning):
+        returned = []
+        row_sql = '(' + ','.join(['%s'] * len(fields)) + ')'
+        for i in range(0, len(rows), self.BULK_BATCH_SIZE):
+            batch = rows[i:i + self.BULK_BATCH_SIZE]
+            sql = 'INSERT INTO {} ({}) VALUES {}{} RETURNING {}'.format(
+                table, ','.join(fields), ','.join([row_sql] * len(batch)), suffix, returning
+            )
+            params = [row[f] for row in batch for f in fields]
+            # each batch length is another statement, not worth a prepared slot
+            cursor = yield self.pg_query(sql, *params, prepare=False)
+            returned += cursor.fetchall()
+        return returned
+
     @coroutine
-    def pg_query(self, query, *params):
-        """ Low level execuation """
-        connection = yield self.pg_getconn()
-        with self.db.manage(connection):
+    def _pg_copy(self, table, fields, types, rows, statement):
+        """
+        COPY rows into a temporary table then run ``statement`` from it.
+        Asynchronous connections can't COPY, so a short-lived blocking
+        connection is used in the thread pool. It commits on its own,
+        so it is not used within ``pg_transaction``.
+
+        :return rows returned by statement, or number of affected rows
+        """
+        assert not self._pg_tx_connection, 'COPY cannot join a transaction'
+        dsn = self.application.config.env['postgres']['dsn']
+
+        def _copy():
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write('\t'.join(_copy_value(row[f], types[f]) for f in fields))
+                buffer.write('\n')
+            buffer.seek(0)
+            connection = psycopg2.connect(dsn)
+            try:
+                with connection, connection.cursor() as cursor:
+                    cursor.execute(
+                        'CREATE TEMP TABLE _tokit_copy ON COMMIT DROP AS '
+                        'SELECT {} FROM {} WITH NO DATA'.format(','.join(fields), table)
+                    )
+                    cursor.execute('ALTER TABLE _tokit_copy ADD COLUMN _tokit_ord bigserial')
+                    cursor.copy_expert('COPY _tokit_copy ({}) FROM STDIN'.format(
+                        ','.join(fields)), buffer)
+                    cursor.execute(statement)
+                    if cursor.description:
+                        return cursor.fetchall()
+                    return cursor.rowcount
+            finally:
+                connection.close()
+
+        self._pg_wrote = True
+        result = yield self.application._thread_executor.submit(_copy)
+        yield self.pg_written(table)
+        return result
+
+    def _pg_use_copy(self, rows):
+        # COPY connection would not be rolled back with the transaction
+        return len(rows) >= self.BULK_COPY_THRESHOLD and not self._pg_tx_connection
+
+    @coroutine
+    def pg_insert_many(self, table, rows, conflict=None, update=None):
+        """
+        Insert many rows (list of dict having same keys) with few round-trips:
+        multi-row VALUES for small batches, COPY FROM STDIN for large ones
+        (except within ``pg_transaction``).
+
+        :param conflict: columns of ON CONFLICT, which turns this to an upsert
+        :param update: columns to update on conflict, default to all others.
+            Without any (DO NOTHING), skipped rows get None as id
+        :return list of ids, in same order as rows
+
+        Example::
+
+            ids = yield self.pg_insert_many('users', [{"username": "foo"}, {"username": "bar"}])
+        """
+        if not rows:
+            return []
+        fields, types = yield self._pg_bulk_fields(table, rows)
+        suffix = self._conflict_sql(fields, conflict, update)
+        skipping = suffix.endswith('DO NOTHING')
+        returning = ','.join(['id'] + list(conflict)) if skipping else 'id'
+        if self._pg_use_copy(rows):
+            statement = 'INSERT INTO {table} ({fields}) ' \
+                        'SELECT {fields} FROM _tokit_copy ORDER BY _tokit_ord{suffix} ' \
+                        'RETURNING {returning}'.format(table=table, fields=','.join(fields),
+                                                       suffix=suffix, returning=returning)
+            returned = yield self._pg_copy(table, fields, types, rows, statement)
+        else:
+            returned = yield self._pg_values_insert(table, fields, rows, suffix, returning)
+        if not skipping:
+            return [row[0] for row in returned]
+        # skipped rows are not returned, match ids back by conflict columns
+        ids = {tuple(str(v) for v in row[1:]): row[0] for row in returned}
+        return [ids.get(tuple(str(row[f]) for f in conflict)) for row in rows]
+
+    @coroutine
+    def pg_upsert_many(self, table, rows, conflict=('id',), update=None):
+        """
+        Insert or update many rows, see ``pg_insert_many``.
+        Rows of a same call must not conflict with each other.
+        """
+        ids = yield self.pg_insert_many(table, rows, conflict=conflict, update=update)
+        return ids
+
+    @coroutine
+    def pg_update_many(self, table, rows, key='id'):
+        """
+        Update many rows at once with ``UPDATE ... FROM (VALUES ...)``,
+        each row must contain ``key`` column
+
+        :return int number of updated rows
+        """
+        if not rows:
+            return 0
+        fields, types = yield self._pg_bulk_fields(table, rows)
+        if key not in fields:
+            raise HTTPError(400, 'Rows must have ' + key)
+        changes = ','.join('{0} = v.{0}'.format(f) for f in fields if f != key)
+        if self._pg_use_copy(rows):
+            statement = 'UPDATE {} AS t SET {} FROM _tokit_copy AS v WHERE t.{key} = v.{key}' \
+                .format(table, changes, key=key)
+            count = yield self._pg_copy(table, fields, types, rows, statement)
+            return count
+
+        # first row is casted so VALUES columns get types of table's columns
+        typed_row = '(' + ','.join('%s::' + types[f] for f in fields) + ')'
+        row_sql = '(' + ','.join(['%s'] * len(fields)) + ')'
+        count = 0
+        for i in range(0, len(rows), self.BULK_BATCH_SIZE):
+            batch = rows[i:i + self.BULK_BATCH_SIZE]
+            sql = 'UPDATE {} AS t SET {} FROM (VALUES {}) AS v ({}) WHERE t.{key} = v.{key}'.format(
+                table, changes,
+                ','.join([typed_row] + [row_sql] * (len(batch) - 1)),
+                ','.join(fields), key=key
+            )
+            params = [row[f] for row in batch for f in fields]
+            cursor = yield self.pg_query(sql, *params, prepare=False)
+            count += cursor.rowcount
+        return count
+
+    _pg_tx_connection = None
+    # connection lent by caller (Batch) for all queries, not in a transaction
+    _pg_shared_connection = None
+    _pg_wrote = False
+
+    @coroutine
+    def pg_query(self, query, *params, prepare=True):
+        """
+        Low level execuation, always on primary
+
+        :param prepare: False to never use a prepared statement for it
+        """
+        written = None
+        if not query.lstrip()[:6].lower() == 'select':
+            self._pg_wrote = True
+            written = _WRITE_TABLE_RE.match(query)
+        connection = self._pg_tx_connection or self._pg_shared_connection
+        if connection:
+            cursor = yield self.pg_execute(connection, query, params, prepare)
+        else:
+            connection = yield self.pg_getconn()
+            with self.db.manage(connection):
+                cursor = yield self.pg_execute(connection, query, params, prepare)
+        if written:
+            yield self.pg_written(written.group(1))
+        return cursor
+
+    @coroutine
+    def pg_written(self, table):
+        """ Hook after a write to ``table``: drop cached results, bump its version """
+        yield self.pg_invalidate(table)
+        if getattr(self.application, 'pg_table_versions', False):
+            yield self.pg_bump_version(table)
+
+    @coroutine
+    def pg_bump_version(self, table):
+        sql = """
+            INSERT INTO tokit_table_versions (name) VALUES (%s)
+            ON CONFLICT (name) DO UPDATE SET
+                version = tokit_table_versions.version + 1, updated_at = now()
+        """
+        params = (_table_name(table),)
+        if self._pg_tx_connection:
+            yield self._pg_tx_connection.execute(sql, params)
+        else:
+            yield self.db.execute(sql, params)
+
+    @coroutine
+    def pg_table_version(self, table):
+        """
+        :return (version, updated_at) of table, None if versions aren't enabled
+            or table was never written
+        """
+        if not getattr(self.application, 'pg_table_versions', False):
+            return None
+        row = yield self.pg_one(
+            'SELECT version, updated_at FROM tokit_table_versions WHERE name = %s',
+            _table_name(table))
+        return (row['version'], row['updated_at']) if row else None
+
+    @coroutine
+    def pg_row_version(self, table, row_id, modified_field=None):
+        """
+        Cheap validators of a row: its ``xmin`` (changed by every update)
+        and optionally a last modified column, without reading the row
+
+        :return (version, last modified or None), None if row doesn't exist
+        """
+        fields = 'xmin::text AS version'
+        if modified_field:
+            fields += ', {} AS modified'.format(modified_field)
+        row = yield self.pg_one('SELECT {} FROM {} WHERE id = %s'.format(fields, table), row_id)
+        if not row:
+            return None
+        return row['version'], row.get('modified')
+
+    @coroutine
+    def pg_invalidate(self, table):
+        """
+        Drop cached results reading ``table``, in this process
+        and others (by NOTIFY, delivered on commit when in a transaction)
+        """
+        cache = getattr(self.application, 'pg_result_cache', None)
+        if not cache:
+            return
+        table = _table_name(table)
+        cache.invalidate(table)
+        sql = 'SELECT pg_notify(%s, %s)'
+        if self._pg_tx_connection:
+            yield self._pg_tx_connection.execute(sql, (cache.CHANNEL, table))
+        else:
+            yield self.db.execute(sql, (cache.CHANNEL, table))
+
+    @coroutine
+    def pg_cached(self, query, params, ttl, tables=None):
+        """
+        Read rows from result cache or database.
+        The cache is filled from primary when this request wrote or one of
+        tables was invalidated within ``replica_max_lag``, as a replica
+        may not have the change yet.
+
+        :param tables: tables read by the query, guessed from FROM / JOIN if not given
+        :return list of dict
+        """
+        cache = getattr(self.application, 'pg_result_cache', None)
+        if not cache or self._pg_tx_connection:
+            result = yield self.pg_read(query, *params)
+            return [dict(row) for row in result.fetchall()]
+        key = query + '\0' + repr(params)
+        rows = cache.get(key)
+        if rows is None:
+            if tables is None:
+                tables = _READ_TABLES_RE.findall(query)
+            tables = [_table_name(t) for t in tables]
+            max_lag = getattr(self.application, 'pg_replica_max_lag', 0)
+            started = time.time()
+            if self._pg_wrote or cache.invalidated_since(tables, started - max_lag):
+                result = yield self.pg_query(query, *params)
+            else:
+                result = yield self.pg_read(query, *params)
+            rows = [dict(row) for row in result.fetchall()]
+            # not if invalidated while reading
+            if not cache.invalidated_since(tables, started):
+                cache.set(key, rows, ttl, set(tables))
+        return rows
+
+    def pg_pick_replica(self):
+        """
+        Replica with least outstanding queries,
+        None if reading must go to primary
+        """
+        app = self.application
+        if self._pg_tx_connection:
+            return None
+        if self._pg_wrote and getattr(app, 'pg_read_your_writes', True):
+            return None
+        replicas = [r for r in getattr(app, 'pg_replicas', ()) if r.healthy]
+        if not replicas:
+            return None
+        return min(replicas, key=lambda r: r.outstanding)
+
+    @coroutine
+    def pg_read(self, query, *params):
+        """ Execute a read only query, on a replica when available """
+        replica = self.pg_pick_replica()
+        if not replica:
+            cursor = yield self.pg_query(query, *params)
+            return cursor
+        replica.outstanding += 1
+        try:
+            connection = yield replica.pool.getconn()
+            with replica.pool.manage(connection):
+                cursor = yield self.pg_execute(connection, query, params)
+                return cursor
+        except (psycopg2.OperationalError, momoko.Pool.DatabaseNotAvailable,
+                momoko.exceptions.PartiallyConnectedError):
+            logger.warning('Replica %s failed, reading from primary', replica.dsn)
+            replica.healthy = False
+        finally:
+            replica.outstanding -= 1
+        cursor = yield self.pg_query(query, *params)
+        return cursor
+
+    @coroutine
+    def pg_transaction(self, callback):
+        """
+        Run ``callback`` coroutine in a transaction on primary,
+        all ``pg_*`` queries made meanwhile use the same connection.
+
+        Example::
+
+            @coroutine
+            def transfer():
+                yield self.pg_update('accounts', {'id': a, 'balance': 0})
+                yield self.pg_insert('logs', account=a)
+
+            yield self.pg_transaction(transfer)
+        """
+        if self._pg_tx_connection:
+            # nested: join the outer transaction
+            result = yield callback()
+            return result
+        shared = self._pg_shared_connection
+        connection = shared or (yield self.pg_getconn())
+        self._pg_tx_connection = connection
+        self._pg_wrote = True
+        try:
+            yield connection.execute('BEGIN')
+            result = yield callback()
+            yield connection.execute('COMMIT')
+            return result
+        except Exception:
+            try:
+                yield connection.execute('ROLLBACK')
+            except psycopg2.Error:
+                logger.exception('Cannot rollback')
+            raise
+        finally:
+            self._pg_tx_connection = None
+            if not shared:
+                self.db.putconn(connection)
+
+    @coroutine
+    def pg_execute(self, connection, query, params=(), prepare=True):
+        """
+        Execute on given connection, using a prepared statement if possible.
+        Each connection keeps its prepared statements in a LRU cache.
+        Not within a transaction, where a failed PREPARE would abort it.
+        """
+        size = getattr(self.application, 'pg_prepared_cache_size', 0)
+        prepare = prepare and size and connection is not self._pg_tx_connection
+        prepared = _prepare_sql(query) if prepare else None
+        if (not prepared or prepared[2] != len(params) or prepared[0] in _unpreparable
+                or any(isinstance(param, tuple) for param in params)):
             cursor = yield connection.execute(query, params)
             return cursor
 
+        name, prepare_sql, num_params = prepared
+        cache = getattr(connection, '_tokit_prepared', None)
+        if cache is None:
+            cache = connection._tokit_prepared = collections.OrderedDict()
+
+        if name in cache:
+            pg_stats['prepared_hit'] += 1
+            cache.move_to_end(name)
+        else:
+            pg_stats['prepared_miss'] += 1
+            while len(cache) >= size:
+                evicted, _ = cache.popitem(last=False)
+                pg_stats['prepared_evict'] += 1
+                yield connection.execute('DEALLOCATE ' + evicted)
+            try:
+                yield connection.execute(prepare_sql)
+            except psycopg2.Error as e:
+                if e.pgcode != DUPLICATE_PREPARED_STATEMENT:
+                    logger.debug('Cannot prepare %s: %s', query, e)
+                    pg_stats['prepared_fail'] += 1
+                    if e.pgcode in _UNPREPARABLE_CODES:
+                        _unpreparable.add(name)
+                    # other errors (missing table, lost connection...) are raised by it
+                    cursor = yield connection.execute(query, params)
+                    return cursor
+            cache[name] = True
+
+        execute_sql = 'EXECUTE ' + name
+        if num_params:
+            execute_sql += '(' + ','.join(['%s'] * num_params) + ')'
+        try:
+            cursor = yield connection.execute(execute_sql, params)
+        except psycopg2.Error as e:
+            if e.pgcode not in (INVALID_STATEMENT_NAME, FEATURE_NOT_SUPPORTED):
+                raise
+            # statement was lost or its plan is stale after a schema change
+            del cache[name]
+            try:
+                yield connection.execute('DEALLOCATE ' + name)
+            except psycopg2.Error:
+                pass
+            cursor = yield connection.execute(query, params)
+        return cursor
+
+    def pg_cache_info(self):
+        """ Statistics of prepared statements, generated SQL and result caches """
+        cache = getattr(self.application, 'pg_result_cache', None)
+        return dict(
+            pg_stats,
+            insert_sql=_insert_sql.cache_info()._asdict(),
+            update_sql=_update_sql.cache_info()._asdict(),
+            result_cache=cache.info() if cache else None,
+        )
+
     def pg_serialize(self, row):
         if not row:
             return
@@ -126,29 +966,177 @@ class PgMixin:
         return ret
 
     @coroutine
-    def pg_select(self, query, *params):
+    def pg_select(self, query, *params, cache=None, tables=None):
         """
         Query and convert each returned row
 
+        :param cache: seconds to keep result in cache, needs ``result_cache_mb`` config
+        :param tables: tags of cached result, default to tables after FROM / JOIN
         :return generator
         """
-        result = yield self.pg_query(query, *params)
+        if cache:
+            rows = yield self.pg_cached(query, params, cache, tables)
+            return (self.pg_serialize(dict(row)) for row in rows)
+        result = yield self.pg_read(query, *params)
         return (self.pg_serialize(row) for row in result.fetchall())
 
     @coroutine
-    def pg_one(self, query, *params):
-        result = yield self.pg_query(query, *params)
+    def pg_get(self, table, row_id):
+        row = yield self.pg_one('SELECT * FROM {} WHERE id = %s'.format(table), row_id)
+        return row
+
+    @coroutine
+    def pg_page(self, table, limit, cursor=None, key='id'):
+        """
+        Keyset pagination: ``WHERE key > last_key ORDER BY key``,
+        which is fast at any depth unlike OFFSET.
+
+        :param cursor: opaque token returned by previous page
+        :return (rows, next cursor or None)
+        """
+        if cursor:
+            try:
+                last_key = json.loads(decode_token(cursor).decode())
+            except ValueError:
+                raise HTTPError(400, 'Invalid cursor')
+            rows = yield self.pg_select(
+                'SELECT * FROM {table} WHERE {key} > %s ORDER BY {key} LIMIT %s'.format(
+                    table=table, key=key), last_key, limit + 1)
+        else:
+            rows = yield self.pg_select(
+                'SELECT * FROM {table} ORDER BY {key} LIMIT %s'.format(
+                    table=table, key=key), limit + 1)
+        rows = list(rows)
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_token(to_json(rows[-1][key]).encode())
+
+    @coroutine
+    def pg_estimate_count(self, table):
+        """ Approximate number of rows from planner statistics, instead of slow COUNT(*) """
+        row = yield self.pg_one(
+            'SELECT reltuples::bigint AS estimate FROM pg_class WHERE oid = %s::regclass', table)
+        return max(row['estimate'], 0) if row else None
+
+    def pg_stream(self, query, *params, batch_size=500):
+        """
+        Read a big result by batches through a server-side cursor,
+        memory usage is bounded by ``batch_size``.
+        The connection is held until the stream is exhausted or closed.
+
+        Example::
+
+            async for rows in self.pg_stream('SELECT * FROM logs'):
+                pass
+
+            # or in a coroutine
+            stream = self.pg_stream('SELECT * FROM logs')
+            rows = yield stream.fetch()  # empty list when done
+
+        :return PgStream
+        """
+        return PgStream(self, query, params, batch_size)
+
+    @coroutine
+    def pg_one(self, query, *params, cache=None, tables=None):
+        if cache:
+            rows = yield self.pg_cached(query, params, cache, tables)
+            if rows:
+                return self.pg_serialize(dict(rows[0]))
+            return
+        result = yield self.pg_read(query, *params)
         row = result.fetchone()
         if row:
             return self.pg_serialize(row)
 
     db_insert = pg_insert
+    db_insert_many = pg_insert_many
+    db_upsert_many = pg_upsert_many
     db_update = pg_update
+    db_update_many = pg_update_many
     db_query = pg_query
+    db_transaction = pg_transaction
     db_select = pg_select
+    db_stream = pg_stream
+    db_page = pg_page
+    db_get = pg_get
+    db_table_version = pg_table_version
+    db_row_version = pg_row_version
+    db_estimate_count = pg_estimate_count
     db_one = pg_one
 
 
+class PgStream:
+    """ Async iterator of row batches, see ``PgMixin.pg_stream`` """
+
+    _counter = itertools.count()
+
+    def __init__(self, mixin, query, params, batch_size):
+        self.mixin = mixin
+        self.query = query
+        self.params = params
+        self.batch_size = batch_size
+        self.name = 'tokit_stream_{}'.format(next(self._counter))
+        self.connection = None
+        self.done = False
+
+    @coroutine
+    def open(self):
+        self.connection = yield self.mixin.pg_getconn()
+        try:
+            yield self.connection.execute('BEGIN')
+            yield self.connection.execute(
+                'DECLARE {} NO SCROLL CURSOR FOR {}'.format(self.name, self.query),
+                self.params
+            )
+        except Exception:
+            yield self.close(commit=False)
+            raise
+
+    @coroutine
+    def fetch(self):
+        """ :return list of next rows, empty when exhausted """
+        if self.done:
+            return []
+        if not self.connection:
+            yield self.open()
+        try:
+            cursor = yield self.connection.execute(
+                'FETCH {} FROM {}'.format(int(self.batch_size), self.name)
+            )
+            rows = cursor.fetchall()
+        except Exception:
+            yield self.close(commit=False)
+            raise
+        if len(rows) < self.batch_size:
+            yield self.close()
+        return [self.mixin.pg_serialize(row) for row in rows]
+
+    @coroutine
+    def close(self, commit=True):
+        """ Release the connection back to pool """
+        self.done = True
+        connection, self.connection = self.connection, None
+        if not connection:
+            return
+        try:
+            yield connection.execute('COMMIT' if commit else 'ROLLBACK')
+        except psycopg2.Error:
+            logger.exception('Cannot close stream %s', self.name)
+        finally:
+            self.mixin.db.putconn(connection)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        rows = await self.fetch()
+        if not rows:
+            raise StopAsyncIteration
+        return rows
+
+
 class UidMixin:
 
     def pg_serialize(self, row):
@@ -156,3 +1144,165 @@ class UidMixin:
         if 'id' in ret:
             ret['short_id'] = shortuuid.encode(ret['id'])
         return ret
+
+
+class PgTasksQueue:
+    """
+    Durable tasks queue shared by all processes and nodes using same database.
+
+    Tasks are rows claimed in batches with ``FOR UPDATE SKIP LOCKED``,
+    consumers are waken up by ``LISTEN / NOTIFY`` instead of polling.
+    A task is leased for ``task_lease_sec`` from when it starts, if its
+    process dies the task will be claimed again by another consumer.
+    A failed task is retried later, after ``task_max_attempts`` it is kept
+    with ``failed_at`` and its error, and never claimed again.
+
+    Enable it in env.ini::
+
+        [app]
+        tasks_backend=postgres
+        task_batch_size=16
+        task_lease_sec=300
+        task_max_attempts=5
+        task_retry_sec=60
+        # delay before a failed task is retried, doubled after each attempt
+
+    Task arguments must be JSON serializable.
+    """
+
+    TABLE = 'tokit_tasks'
+    CHANNEL = 'tokit_tasks'
+
+    def __init__(self, app):
+        self.app = app
+        self.db = app.pg_db
+        env = app.config.env['app']
+        self.batch_size = env.getint('task_batch_size', 16)
+        self.lease = env.getint('task_lease_sec', 300)
+        self.max_attempts = env.getint('task_max_attempts', 5)
+        self.retry = env.getint('task_retry_sec', 60)
+        self.wakeup = Condition()
+        self.listener = None
+
+    @coroutine
+    def setup(self):
+        yield self.db.execute("""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id bigserial PRIMARY KEY,
+                priority int NOT NULL DEFAULT 0,
+                name text NOT NULL,
+                payload jsonb NOT NULL,
+                locked_until timestamptz,
+                created_at timestamptz NOT NULL DEFAULT now()
+            );
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS attempts int NOT NULL DEFAULT 0;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS failed_at timestamptz;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS error text;
+            CREATE INDEX IF NOT EXISTS {table}_order_idx ON {table} (priority, id);
+        """.format(table=self.TABLE))
+
+    def listen(self):
+        self.listener = pg_listen(
+            self.app.config.env['postgres']['dsn'], self.CHANNEL,
+            lambda notifies: self.wakeup.notify_all(),
+            on_reconnect=self.wakeup.notify_all
+        )
+
+    def put(self, name, args, kwargs, priority=0):
+        """ :return Future """
+        sql = 'INSERT INTO {} (priority, name, payload) VALUES (%s, %s, %s::jsonb); ' \
+              'NOTIFY {}'.format(self.TABLE, self.CHANNEL)
+        payload = to_json({'args': args, 'kwargs': kwargs})
+        return self.db.execute(sql, (priority, name, payload))
+
+    @coroutine
+    def claim(self):
+        cursor = yield self.db.execute("""
+            UPDATE {table} SET locked_until = now() + %s * interval '1 second'
+            WHERE id IN (
+                SELECT id FROM {table}
+                WHERE (locked_until IS NULL OR locked_until < now()) AND failed_at IS NULL
+                ORDER BY priority, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, priority, name, payload, attempts, locked_until
+        """.format(table=self.TABLE), (self.lease, self.batch_size))
+        return sorted(cursor.fetchall(), key=lambda row: (row['priority'], row['id']))
+
+    @coroutine
+    def consumer(self):
+        while True:
+            try:
+                rows = yield self.claim()
+            except psycopg2.Error:
+                logger.exception('Cannot claim tasks')
+                rows = None
+            if not rows:
+                # notification may be missed while claiming, so never wait forever
+                yield self.wakeup.wait(timeout=timedelta(seconds=5))
+                continue
+            for row in rows:
+                yield self.run(row)
+
+    @coroutine
+    def extend(self, row):
+        """
+        Lease a claimed task from now on, tasks of a batch start one after another.
+
+        :return False if the lease expired and another consumer claimed it
+        """
+        cursor = yield self.db.execute("""
+            UPDATE {} SET locked_until = now() + %s * interval '1 second'
+            WHERE id = %s AND locked_until = %s
+        """.format(self.TABLE), (self.lease, row['id'], row['locked_until']))
+        return cursor.rowcount == 1
+
+    @coroutine
+    def run(self, row):
+        from tokit.tasks import run_task
+        task = dict(name=row['name'], **row['payload'])
+        try:
+            if not (yield self.extend(row)):
+                return
+        except psycopg2.Error:
+            logger.exception('Cannot lease task %s', row['id'])
+            return
+        try:
+            yield run_task(self.app, task)
+        except Exception as e:
+            logger.exception('Task failed: %s', task['name'])
+            error = e
+        else:
+            error = None
+        try:
+            if error is None:
+                yield self.db.execute('DELETE FROM {} WHERE id = %s'.format(self.TABLE), (row['id'],))
+            else:
+                yield self.fail(row, error)
+        except psycopg2.Error:
+            # lease expires, the task will run again
+            logger.exception('Cannot finish task %s', row['id'])
+
+    @coroutine
+    def fail(self, row, error):
+        """ Retry a failed task later, or keep it as failed after too many attempts """
+        attempts = row['attempts'] + 1
+        failed = attempts >= self.max_attempts
+        yield self.db.execute("""
+            UPDATE {} SET attempts = %s, error = %s,
+                locked_until = now() + %s * interval '1 second',
+                failed_at = CASE WHEN %s THEN now() END
+            WHERE id = %s
+        """.format(self.TABLE), (
+            attempts, repr(error), self.retry * 2 ** (attempts - 1), failed, row['id']
+        ))
+        if failed:
+            logger.error('Task %s (%s) failed %d times, given up', row['id'], row['name'], attempts)
+
+    @coroutine
+    def start(self, num_consumers):
+        yield self.setup()
+        self.listen()
+        for _ in range(num_consumers):
+            IOLoop.current().spawn_callback(self.consumer)
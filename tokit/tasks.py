@@ -1,17 +1,25 @@
 import os
+import time
+import itertools
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
-from tornado.queues import PriorityQueue, QueueEmpty
-from tornado.gen import sleep, coroutine
+from tornado.queues import PriorityQueue, QueueFull
+from tornado.gen import coroutine, is_coroutine_function
 from tokit import Event, on, logger
 from inspect import iscoroutinefunction
 from email.mime.text import MIMEText
 import smtplib
 from email.header import Header
-from tornado.gen import coroutine
 from tornado.concurrent import run_on_executor
+from tornado.web import HTTPError
 
 tasks_queue = PriorityQueue()
+_tasks_counter = itertools.count()
+
+tasks_backend = None
+""" Durable queue used instead of ``tasks_queue``, see ``tokit.postgres.PgTasksQueue`` """
+
 
 def put(name, *args, priority=0, **kwargs):
     """
@@ -26,81 +34,279 @@ def put(name, *args, priority=0, **kwargs):
             pass
 
         put('task_xyz', 'val1')
+
+    :return: Future, resolved when the task was accepted by the queue.
+        Yield it to wait while the queue is full (backpressure),
+        use ``put_nowait`` when not waiting
+    """
+    if tasks_backend:
+        return tasks_backend.put(name, args, kwargs, priority=priority)
+    return tasks_queue.put(_queue_item(name, args, kwargs, priority))
+
+
+def put_nowait(name, *args, priority=0, **kwargs):
+    """
+    Schedule a task without waiting, for fire-and-forget callers
+
+    :raise QueueFull: when the queue is full, the task is not scheduled
     """
-    tasks_queue.put((priority, {'name': name, 'args': args, 'kwargs': kwargs}))
+    if tasks_backend:
+        tasks_backend.put(name, args, kwargs, priority=priority)
+        return
+    tasks_queue.put_nowait(_queue_item(name, args, kwargs, priority))
+
+
+def _queue_item(name, args, kwargs, priority):
+    # counter keeps FIFO order for same priority and avoid comparing dicts
+    return priority, next(_tasks_counter), {'name': name, 'args': args, 'kwargs': kwargs}
 
 
 @coroutine
-def tasks_consumer(app):
+def run_task(app, task):
     """
-    Check for pending and excute tasks
+    Excute all handlers of a task
 
     A task handler can be coroutine (run in event loop)
-    or normal function (run in thread - can be blocking)
+    or normal function (run in app's thread pool - can be blocking)
+    """
+    handlers = Event.get(task['name']).handlers
+    if not handlers:
+        logger.warn('No handler for task: %s', task['name'])
+        return
+    for handler in handlers:
+        if iscoroutinefunction(handler) or is_coroutine_function(handler):
+            yield handler(app, *task['args'], **task['kwargs'])
+        else:
+            yield app._thread_executor.submit(
+                handler, app, *task['args'], **task['kwargs']
+            )
+
+
+@coroutine
+def tasks_consumer(app):
+    """
+    Wait for pending tasks and excute them, one at a time
     """
     while True:
-        # another way: use Postgres notfiy / listen
-        # http://initd.org/psycopg/docs/advanced.html#asynchronous-notifications
-        yield sleep(0.3)
+        priority, _, task = yield tasks_queue.get()
         try:
-            priority, task = tasks_queue.get_nowait()
-            handlers = Event.get(task['name']).handlers
-            handler = None
-            for handler in handlers:
-                if iscoroutinefunction(handler):
-                    yield handler(
-                        app,
-                        *task.get('args'),
-                        **task.get('kwargs')
-                    )
-                else:
-                    with ThreadPoolExecutor() as executor:
-                        yield executor.submit(
-                            handler,
-                            app,
-                            *task.get('args'),
-                            **task.get('kwargs')
-                        )
-            if not handler:
-                logger.warn('No handler for task: %s', task['name'])
-        except QueueEmpty:
-            pass
-        else:
+            yield run_task(app, task)
+        except Exception:
+            logger.exception('Task failed: %s', task['name'])
+        finally:
             tasks_queue.task_done()
 
 
 def register_task_runner(app):
+    """
+    Start consumers for tasks queue
+
+    Sample env.ini::
+
+        [app]
+        task_workers=4
+        # number of tasks running concurrently
+        task_queue_size=1000
+        # 0 means unbounded
+        tasks_backend=memory
+        # or postgres, to share tasks between processes
+    """
+    global tasks_queue, tasks_backend
     from tornado.ioloop import IOLoop
-    IOLoop.current().spawn_callback(lambda: tasks_consumer(app))
+    env = app.config.env['app']
+    num_consumers = env.getint('task_workers', 4)
 
-@on('send_email')
-@coroutine
-def send_email_consumer(app, receipt, body, subject=None):
+    if env.get('tasks_backend', 'memory') == 'postgres':
+        from tokit.postgres import PgTasksQueue
+        tasks_backend = PgTasksQueue(app)
+        IOLoop.current().spawn_callback(tasks_backend.start, num_consumers)
+        return
+
+    queue_size = env.getint('task_queue_size', 1000)
+    if tasks_queue.maxsize != queue_size:
+        pending = []
+        while not tasks_queue.empty():
+            pending.append(tasks_queue.get_nowait())
+        tasks_queue = PriorityQueue(maxsize=queue_size)
+        for item in pending:
+            tasks_queue.put(item)
+    for _ in range(num_consumers):
+        IOLoop.current().spawn_callback(tasks_consumer, app)
+
+class SmtpPool:
+    """
+    Keep authenticated SMTP connections and send messages through them
+    in a dedicated thread pool, so the IOLoop is never blocked.
+    Each ``send`` call delivers a batch of messages over one connection.
+
+    Sample env.ini::
+
+        [smtp]
+        host=localhost
+        port=25
+        tls=False
+        user=
+        password=
+        pool_size=2
+        batch_size=20
+        idle_timeout=60
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.size = config.getint('pool_size', 2)
+        self.batch_size = config.getint('batch_size', 20)
+        self.idle_timeout = config.getint('idle_timeout', 60)
+        self.executor = ThreadPoolExecutor(max_workers=self.size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        config = self.config
+        mailer = smtplib.SMTP(config['host'], config.get('port'))
+        if config.getboolean('tls'):
+            mailer.starttls()
+        if config.get('user'):
+            mailer.login(config.get('user'), config['password'])
+        return mailer
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                mailer, last_used = self._idle.pop()
+            if time.time() - last_used < self.idle_timeout:
+                return mailer
+            # server may have closed it
+            self.discard(mailer)
+        return self.connect()
+
+    def release(self, mailer):
+        with self._lock:
+            self._idle.append((mailer, time.time()))
+
+    def discard(self, mailer):
+        try:
+            mailer.quit()
+        except (smtplib.SMTPException, OSError):
+            mailer.close()
+
+    MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+    """ Errors of one message, the connection is still usable for next ones """
+
+    def _send_message(self, mailer, msg):
+        refused = mailer.send_message(msg)
+        if refused:
+            # some recipients got it
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+    def _send_batch(self, messages):
+        mailer = self.acquire()
+        results = []
+        try:
+            for msg in messages:
+                try:
+                    try:
+                        self._send_message(mailer, msg)
+                    except smtplib.SMTPServerDisconnected:
+                        mailer.close()
+                        mailer = self.connect()
+                        self._send_message(mailer, msg)
+                except self.MESSAGE_ERRORS as e:
+                    logger.warning('Cannot send email to %s: %s', msg['To'], e)
+                    results.append(e)
+                else:
+                    results.append(None)
+        except Exception:
+            self.discard(mailer)
+            raise
+        self.release(mailer)
+        return results
+
+    def send(self, messages):
+        """
+        :return Future resolved with a result per message:
+            None when sent, else the error (``MESSAGE_ERRORS``)
+        """
+        return self.executor.submit(self._send_batch, messages)
+
+    @coroutine
+    def send_many(self, messages):
+        """ Split messages in batches, sent concurrently over the pool, see ``send`` """
+        batches = [
+            messages[i:i + self.batch_size]
+            for i in range(0, len(messages), self.batch_size)
+        ]
+        results = yield [self.send(batch) for batch in batches]
+        return [result for batch in results for result in batch]
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for mailer, _ in idle:
+            self.discard(mailer)
+        self.executor.shutdown(wait=False)
+
+
+def get_mailer(app):
+    mailer = getattr(app, 'smtp_pool', None)
+    if not mailer:
+        mailer = app.smtp_pool = SmtpPool(app.config.env['smtp'])
+    return mailer
+
+
+def make_email(app, receipt, body, subject=None):
     if not subject:
         # consider first line as subject
         subject, body = body.split("\n", 1)
     msg = MIMEText(body, 'plain', 'utf-8')
-    config = app.config.env['smtp']
     msg['Subject'] = Header(subject, 'utf-8')
-    msg['From'] = config['from']
+    msg['From'] = app.config.env['smtp']['from']
     msg['To'] = receipt
-    with smtplib.SMTP(config['host'], config.get('port')) as mailer:
-        if config.getboolean('tls'):
-            mailer.starttls()
-        if config.get('user'):
-            mailer.login(config.get('user'), config['password'])
-        mailer.send_message(msg)
-        mailer.quit()
+    return msg
+
+
+@on('send_email')
+@coroutine
+def send_email_consumer(app, receipt, body, subject=None):
+    error, = yield get_mailer(app).send([make_email(app, receipt, body, subject)])
+    if error:
+        raise error
     logger.debug("Sent email to %s", receipt)
 
 
+@on('send_bulk_email')
+@coroutine
+def send_bulk_email_consumer(app, receipts, body, subject=None):
+    messages = [make_email(app, receipt, body, subject) for receipt in receipts]
+    results = yield get_mailer(app).send_many(messages)
+    failed = sum(1 for error in results if error)
+    logger.debug("Sent %d emails, %d failed", len(results) - failed, failed)
+
+
 class EmailMixin:
+    """ Emails are queued without waiting, a full tasks queue answers 503 """
 
     def send_email(self, template, receipt, **kwargs):
         content = self.render_string(
             os.path.join(self.application.root_path, template), **kwargs
         ).decode()
-        put('send_email', receipt, content)
+        self._put_email('send_email', receipt, content)
+
+    def send_bulk_email(self, template, receipts, **kwargs):
+        """ Send same content to many receipts, batched per SMTP connection """
+        content = self.render_string(
+            os.path.join(self.application.root_path, template), **kwargs
+        ).decode()
+        self._put_email('send_bulk_email', list(receipts), content)
+
+    def _put_email(self, task, *args):
+        try:
+            put_nowait(task, *args)
+        except QueueFull:
+            logger.error('Tasks queue is full, %s dropped', task)
+            raise HTTPError(503, 'Too many pending tasks')
 
 
 @on('init')
@@ -1,6 +1,10 @@
 import re
 import os
-from collections import ChainMap, defaultdict
+import sys
+import time
+import marshal
+import hashlib
+import importlib.util
 
 from tornado.template import (
     Loader, ParseError,
@@ -11,8 +15,11 @@ try:
 except:
     pass
 
+import tornado
 from tornado import locale
-from tokit.utils import on
+from tornado.web import RequestHandler
+from tokit.utils import on, cached_property
+from tokit import logger
 
 
 
@@ -21,26 +28,88 @@ SHORTCUT_RE = [
     (re.compile(rb'{\*\s*([\w\_]+)\s*\*}', re.DOTALL),              rb'{{ _("\1") }}'),
 ]
 
-def init_locale(config):
+TEMPLATE_DEPS_RE = [
+    re.compile(rb'{%\s*(?:extends|include)\s+["\']?([^"\'%\s]+)'),
+    # Jade
+    re.compile(rb'^\s*(?:extends|include)\s+(\S+)', re.M),
+]
+
+TEMPLATE_EXTS = ('.html', '.jade')
+
+def _csv_files(lang_paths):
+    for lang_path in lang_paths:
+        for f in sorted(os.listdir(lang_path)):
+            if f.endswith('.csv'):
+                yield os.path.join(lang_path, f)
+
+
+def _catalog_key(lang_paths):
+    """ Changes with any CSV (or the module order) """
+    hasher = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+    for lang_path in lang_paths:
+        hasher.update(lang_path.encode('utf8') + b'\0')
+    for path in _csv_files(lang_paths):
+        stat = os.stat(path)
+        hasher.update('{}:{}:{}\0'.format(path, stat.st_mtime, stat.st_size).encode('utf8'))
+    return hasher.hexdigest()
+
+
+def build_translations(lang_paths):
     """
-    Load per-module ``lang`` folder CSV translations
+    Merge CSV translations of ``lang_paths`` into one flat dict per locale
+    and plural form, first path wins when a key is translated twice
     """
-    chain = defaultdict(lambda: defaultdict(ChainMap))
-
-    for m in config.modules_loaded:
-        lang_path = os.path.join(config.root_path, m, 'lang')
-        if not os.path.exists(lang_path):
-            continue
+    merged = {}
+    for lang_path in lang_paths:
+        # load_translations replaces previous translations on each call
         locale.load_translations(lang_path)
-
-        # old translations is overrided by a `load` call,
-        # so this is a hack to chain all mobule's translations into bigger one
         for lang, plurals in locale._translations.items():
             for plural, translation in plurals.items():
-                chain[lang][plural].maps.append(translation)
+                flat = merged.setdefault(lang, {}).setdefault(plural, {})
+                for key, value in translation.items():
+                    flat.setdefault(key, value)
+    return merged
+
 
-    locale._translations = chain
-    locale._supported_locales = frozenset(list(chain.keys()) + [locale._default_locale])
+def init_locale(config, catalog_file=None):
+    """
+    Load per-module ``lang`` folder CSV translations, flattened into a
+    catalog file which is only rebuilt when a CSV changes
+
+    Sample env.ini::
+
+        [app]
+        # relative to project root
+        locale_catalog=../tmp/locale.catalog
+    """
+    if catalog_file is None:
+        catalog_file = config.env['app'].get('locale_catalog', '../tmp/locale.catalog')
+        catalog_file = os.path.join(config.root_path, catalog_file)
+
+    lang_paths = [os.path.join(config.root_path, m, 'lang') for m in config.modules_loaded]
+    lang_paths = [p for p in lang_paths if os.path.exists(p)]
+    key = _catalog_key(lang_paths)
+
+    translations = None
+    try:
+        with open(catalog_file, 'rb') as f:
+            catalog = marshal.loads(f.read())
+        if catalog['key'] == key:
+            translations = catalog['translations']
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    if translations is None:
+        translations = build_translations(lang_paths)
+        os.makedirs(os.path.dirname(catalog_file), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(catalog_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            f.write(marshal.dumps({'key': key, 'translations': translations}))
+        os.replace(tmp_file, catalog_file)
+
+    locale._translations = translations
+    locale._supported_locales = frozenset(list(translations.keys()) + [locale._default_locale])
+    locale.Locale._cache = {}
 
 
 class CustomLoader(Loader):
@@ -57,21 +126,80 @@ class CustomLoader(Loader):
             ret = regex.sub(replacement, ret)
         return ret
 
+    cache_path = None
+    """ Directory of generated template code, see ``init_template_cache`` """
+
     def _create_template(self, name):
         path = os.path.join(self.root, name)
         with open(path, "rb") as f:
-            try:
-                EngineClass = self._get_template_engine(name)
-                template = EngineClass(
-                    self._custom_prepocessor(f.read()),
-                    name=name, loader=self,
-                    compress_whitespace=False
-                )
+            content = f.read()
+        EngineClass = self._get_template_engine(name)
+        key = self._cache_key(name, EngineClass, content) if self.cache_path else None
+        if key:
+            template = self._load_cached(key, name, EngineClass, content)
+            if template:
                 return template
-            except ParseError as exception:
-                exception.args = exception.args + (path, )
-                raise
-                
+        try:
+            template = EngineClass(
+                self._custom_prepocessor(content),
+                name=name, loader=self,
+                compress_whitespace=False
+            )
+        except ParseError as exception:
+            exception.args = exception.args + (path, )
+            raise
+        if key:
+            self._save_cached(key, template)
+        return template
+
+    def _dependencies(self, name, content, found):
+        """ Extended and included templates are part of the generated code """
+        for regex in TEMPLATE_DEPS_RE:
+            for match in regex.finditer(content):
+                dependency = self.resolve_path(match.group(1).decode('utf8'), parent_path=name)
+                if dependency in found:
+                    continue
+                try:
+                    with open(os.path.join(self.root, dependency), 'rb') as f:
+                        found[dependency] = f.read()
+                except OSError:
+                    continue
+                self._dependencies(dependency, found[dependency], found)
+        return found
+
+    def _cache_key(self, name, EngineClass, content):
+        engine = sys.modules.get(EngineClass.__module__.split('.')[0])
+        hasher = hashlib.sha256()
+        for part in (
+            EngineClass.__module__, EngineClass.__name__, tornado.version,
+            getattr(engine, '__version__', ''), importlib.util.MAGIC_NUMBER,
+            repr(SHORTCUT_RE), repr(self.autoescape), name, content,
+        ):
+            hasher.update(part if isinstance(part, bytes) else str(part).encode('utf8'))
+            hasher.update(b'\0')
+        for dependency, dependency_content in sorted(self._dependencies(name, content, {}).items()):
+            hasher.update(dependency.encode('utf8') + b'\0' + dependency_content + b'\0')
+        return hasher.hexdigest()
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_path, key[:2], key)
+
+    def _load_cached(self, key, name, EngineClass, content):
+        try:
+            with open(self._cache_file(key), 'rb') as f:
+                code, compiled = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return CachedTemplate(name, self, code, compiled, EngineClass, self._custom_prepocessor(content))
+
+    def _save_cached(self, key, template):
+        target = self._cache_file(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(target, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            marshal.dump((template.code, template.compiled), f)
+        os.replace(tmp_file, target)
+
     def _get_template_engine(self, name):
         if name.endswith('.jade'):
             return JadeTemplate
@@ -79,6 +207,79 @@ class CustomLoader(Loader):
         return TornadoTemplate
 
 
+class CachedTemplate(TornadoTemplate):
+    """
+    Template restored from its generated code: nothing to parse nor compile.
+    The parse tree is only rebuilt if a child template extends it.
+    """
+
+    def __init__(self, name, loader, code, compiled, EngineClass, source):
+        self.name = name
+        self.loader = loader
+        self.code = code
+        self.compiled = compiled
+        self.namespace = loader.namespace
+        self.autoescape = loader.autoescape
+        self._engine = EngineClass
+        self._source = source
+
+    @cached_property
+    def file(self):
+        return self._engine(
+            self._source, name=self.name, loader=self.loader,
+            compress_whitespace=False
+        ).file
+
+
+@on('init')
+def init_template_cache(app):
+    """
+    Sample env.ini::
+
+        [app]
+        # generated code of templates, relative to project root, empty to disable
+        template_cache_path=../tmp/templates
+        # compile templates of all modules at startup
+        template_warm_up=False
+    """
+    env = app.config.env['app']
+    cache_path = env.get('template_cache_path', '../tmp/templates')
+    CustomLoader.cache_path = os.path.join(app.config.root_path, cache_path) if cache_path else None
+    if env.getboolean('template_warm_up', False):
+        warm_up_templates(app)
+
+
+def warm_up_templates(app):
+    """
+    Load every template under module dirs into the loaders requests will use.
+    Handlers without ``TranslationMixin`` rendering from these dirs get a
+    ``CustomLoader`` as well.
+    """
+    started = time.time()
+    kwargs = {}
+    if "autoescape" in app.settings:
+        kwargs["autoescape"] = app.settings["autoescape"]
+    count = 0
+    for m in app.config.modules_loaded:
+        # same key as RequestHandler.render_string: dir of handler's file
+        template_path = os.path.dirname(sys.modules[m].__file__)
+        with RequestHandler._template_loader_lock:
+            loader = RequestHandler._template_loaders.get(template_path)
+            if not loader:
+                loader = RequestHandler._template_loaders[template_path] = CustomLoader(template_path, **kwargs)
+        for base_path, _, files in os.walk(template_path):
+            for f in files:
+                if not f.endswith(TEMPLATE_EXTS):
+                    continue
+                name = os.path.relpath(os.path.join(base_path, f), template_path)
+                try:
+                    loader.load(name)
+                    count += 1
+                except Exception as e:
+                    logger.warning('Cannot compile template %s: %s', os.path.join(base_path, f), e)
+    logger.info('Compiled %d templates in %.2fs', count, time.time() - started)
+
+
 class TranslationMixin:
 
     def create_template_loader(self, template_path):
@@ -1,10 +1,15 @@
 from time import time
+import base64
 import binascii
 import hashlib
 import json
+import math
+import threading
 from contextlib import contextmanager
 from datetime import datetime
+from enum import Enum
 from json import JSONEncoder
+from json.encoder import encode_basestring, encode_basestring_ascii, c_make_encoder
 from uuid import UUID
 import shortuuid
 
@@ -74,36 +79,213 @@ class AttrDict(dict):
 
 class VersatileEncoder(JSONEncoder):
     """
-    Encode all "difficult" object such as UUID
+    Encode all "difficult" object such as UUID.
+    Strings are escaped for HTML ``<script>`` as they are encoded.
     """
 
-    def _iterencode(self, obj, markers=None):
+    def default(self, obj):
+        return _json_default(obj)
+
+    def encode(self, o):
+        if isinstance(o, str):
+            return self._encode_str(o)
+        return ''.join(self.iterencode(o, _one_shot=True))
+
+    def _encode_str(self, s):
+        ret = encode_basestring_ascii(s) if self.ensure_ascii else encode_basestring(s)
+        if '</' in s:
+            ret = ret.replace('</', '<\\/')
+        return ret
+
+    def iterencode(self, o, _one_shot=False):
+        if c_make_encoder is None or self.indent is not None:
+            # a string is never split between chunks
+            return (chunk.replace('</', '<\\/') for chunk in super().iterencode(o, _one_shot))
+        return c_make_encoder(
+            {} if self.check_circular else None, self.default, self._encode_str, self.indent,
+            self.key_separator, self.item_separator, self.sort_keys, self.skipkeys, self.allow_nan
+        )(o, 0)
+
+
+def _json_default(obj):
+    """
+    Shared by all backends so they give same output:
+    namedtuple as array (same as tuple), Enum as its value, anything else
+    unknown (UUID, datetime, Decimal, dataclass...) as its ``str()``
+    """
+    if isinstance(obj, tuple):
+        return list(obj)
+    if isinstance(obj, Enum):
+        return obj.value
+    return str(obj)
+
+
+def _json_normalize(obj):
+    """ Copy of obj with NaN / Infinity as None and keys of other types than JSON's as ``str()`` """
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {
+            key if isinstance(key, (str, int, float, bool)) or key is None else str(key):
+                _json_normalize(value)
+            for key, value in obj.items()
+        }
+    if isinstance(obj, (list, tuple)):
+        return [_json_normalize(item) for item in obj]
+    return obj
+
+
+def _stdlib_dumps(obj, _encoder=VersatileEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)):
+    try:
+        return _encoder.encode(obj)
+    except (ValueError, TypeError) as e:
+        # NaN or a key like UUID, written as orjson does
+        if not str(e).startswith(('Out of range float', 'keys must be')):
+            raise
+        return _encoder.encode(_json_normalize(obj))
+
+
+def _orjson_dumps(obj):
+    try:
+        ret = orjson.dumps(obj, default=_json_default, option=_ORJSON_OPTIONS)
+    except orjson.JSONEncodeError:
+        # e.g integers over 64 bits or keys other than str, which stdlib supports
+        return _stdlib_dumps(obj)
+    # orjson can't escape by itself, check bytes before decoding
+    if b'</' in ret:
+        ret = ret.replace(b'</', b'<\\/')
+    return ret.decode()
 
-        if isinstance(obj, tuple) and hasattr(obj, '_asdict'):
-            gen = self._iterencode_dict(obj._asdict(), markers)
-        else:
-            gen = JSONEncoder._iterencode(self, obj, markers)
-        for chunk in gen:
-            yield chunk
 
-    def default(self, obj):
-        if isinstance(obj, UUID):
-            return str(obj)
-        elif isinstance(obj, datetime):
-            return str(obj)
-        else:
-            try:
-                return JSONEncoder.default(self, obj)
-            except TypeError:
-                return str(obj)
+try:
+    import orjson
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+except ImportError:
+    orjson = None
+
+JSON_BACKENDS = dict(json=_stdlib_dumps)
+if orjson:
+    JSON_BACKENDS['orjson'] = _orjson_dumps
+
+_json_dumps = JSON_BACKENDS.get('orjson', _stdlib_dumps)
+
+
+def set_json_backend(name):
+    """
+    Choose encoder of ``to_json``: ``orjson`` or ``json`` (stdlib),
+    by default orjson if installed.
+
+    :raise KeyError: if backend isn't installed
+    """
+    global _json_dumps
+    _json_dumps = JSON_BACKENDS[name]
+
+
+@on('config')
+def setup_json_backend(config):
+    name = config.env['app'].get('json_backend', 'auto')
+    if name != 'auto':
+        set_json_backend(name)
 
 
 def to_json(obj):
-    return json.dumps(obj, ensure_ascii=False, cls=VersatileEncoder).replace("</", "<\\/")
+    """
+    Compact JSON, safe to embed in HTML ``<script>``.
+    Both backends write NaN / Infinity as null and keys of any type as strings,
+    only floats in exponent notation may be written differently (``1e-7`` / ``1e-07``).
+
+    >>> to_json({'id': UUID(int=1), 'tag': '</script>', 'at': datetime(2017, 1, 2)})
+    '{"id":"00000000-0000-0000-0000-000000000001","tag":"<\\\\/script>","at":"2017-01-02 00:00:00"}'
+    >>> to_json({UUID(int=1): float('nan')})
+    '{"00000000-0000-0000-0000-000000000001":null}'
+
+    Same for each backend, including a string at top level:
+
+    >>> outputs = set()
+    >>> for name in JSON_BACKENDS:
+    ...     set_json_backend(name)
+    ...     outputs.add(to_json('</script>') + to_json(['</a', {'</b': 1}]))
+    >>> set_json_backend('orjson' if 'orjson' in JSON_BACKENDS else 'json')
+    >>> outputs
+    {'"<\\\\/script>"["<\\\\/a",{"<\\\\/b":1}]'}
+    """
+    return _json_dumps(obj)
+
+
+def to_json_chunks(obj, chunk_size=65536):
+    """
+    Encode a big list or dict piece by piece, each piece is about ``chunk_size``
+    characters, so a large payload can be written progressively.
+    Joined chunks are same as ``to_json(obj)``.
+    """
+    if isinstance(obj, (list, tuple)):
+        opening, closing = '[', ']'
+        items = (to_json(item) for item in obj)
+    elif isinstance(obj, dict):
+        opening, closing = '{', '}'
+        items = (to_json(str(key)) + ':' + to_json(value) for key, value in obj.items())
+    else:
+        yield to_json(obj)
+        return
+
+    buffer = [opening]
+    size = 0
+    for i, item in enumerate(items):
+        if i:
+            buffer.append(',')
+        buffer.append(item)
+        size += len(item)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    buffer.append(closing)
+    yield ''.join(buffer)
 
 def from_json(s):
     return AttrDict(json.loads(s))
 
+def parse_json(data):
+    """ Parse JSON from str or UTF-8 bytes, without decoding to str first when possible """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_too_deep(obj, max_depth):
+    """
+    Check nesting of parsed JSON, containers at top level have depth 1
+
+    >>> json_too_deep({'a': [1, {'b': []}]}, 2)
+    True
+    """
+    stack = [(obj, 1)]
+    while stack:
+        obj, depth = stack.pop()
+        if isinstance(obj, dict):
+            obj = obj.values()
+        elif not isinstance(obj, list):
+            continue
+        if depth > max_depth:
+            return True
+        stack.extend((item, depth + 1) for item in obj if isinstance(item, (dict, list)))
+    return False
+
+def encode_token(data):
+    """
+    Opaque URL-safe token from bytes, such as a pagination cursor
+
+    >>> decode_token(encode_token(b'42'))
+    b'42'
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def decode_token(token):
+    """ :raise ValueError: if token is malformed """
+    token = token.encode()
+    try:
+        return base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+    except binascii.Error as e:
+        raise ValueError(str(e))
+
 def make_rand(length=16):
     return shortuuid.ShortUUID().random(length)
 
@@ -155,6 +337,27 @@ class cached_property(object):
         value = obj.__dict__[self.func.__name__] = self.func(obj)
         return value
 
+class cached_classproperty(object):
+    """
+    Like ``cached_property`` but computed from the class on first access,
+    then replaced by a class attribute. Executor threads may race for it.
+    """
+
+    def __init__(self, func):
+        self.__doc__ = getattr(func, '__doc__')
+        self.func = func
+        self.lock = threading.Lock()
+
+    def __get__(self, obj, cls):
+        name = self.func.__name__
+        with self.lock:
+            value = cls.__dict__.get(name, self)
+            if isinstance(value, cached_classproperty):
+                value = self.func(cls)
+                setattr(cls, name, value)
+        return value
+
+
 class cached_property_ttl(object):
     """
     A property that is only computed once per instance and then replaces itself